@@ -0,0 +1,198 @@
+"""
+Asyncio interface for services that load and compile notebooks on
+demand (e.g. alongside JupyterHub).
+
+Notebook sources are read without blocking the event loop: files and
+pinned git sources on an executor, HTTP with aiohttp when it is
+installed (otherwise requests on an executor). All the notebooks of an
+include DAG are fetched concurrently, one level at a time, before the
+parse and compose steps, which are CPU-bound, run on the executor too.
+
+    nb = await NoteBook.aload('sessions/geodemographics.ipynb')
+    compiled = await nb.acompile()
+"""
+
+import asyncio
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+from .core import Cell, NoteBook, read_nb, resolve_nb_src
+
+# NoteBook construction fills in a (possibly shared) registry, so loads
+# into one registry are serialised and never parse an atom twice. Loads
+# into different registries run in parallel. A registry's lock exists
+# only while loads into it are in flight: registries are plain dicts,
+# which cannot be weakly referenced, so it is keyed by id() instead.
+_locks_guard = threading.Lock()
+_registry_locks = {}  # id(registry) -> [lock, number of users]
+
+
+@contextmanager
+def registry_lock(registry):
+    """Hold the lock for loads into one registry"""
+    key = id(registry)
+    with _locks_guard:
+        entry = _registry_locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _locks_guard:
+            entry[1] -= 1
+            if not entry[1]:
+                del _registry_locks[key]
+
+
+def _reads_nb(text, nb_src):
+    from .validate import reads_nb
+
+    nb = reads_nb(text, nb_src)
+    nb.metadata['path'] = nb_src
+    return nb
+
+
+async def aread_nb(nb_src, ext=True, executor=None, session=None):
+    """
+    Asynchronous read_nb.
+
+    Parameters
+    ==========
+    nb_src: String
+        Path, URL or pinned git source of the notebook (see read_nb).
+    ext: boolean
+        Append '.ipynb' if missing.
+    executor: concurrent.futures.Executor
+        Executor for blocking reads and parsing. Defaults to the loop's.
+    session: aiohttp.ClientSession
+        Optional session to reuse for HTTP sources.
+
+    Returns
+    =======
+    An object of class nbformat.notebooknode.NotebookNode, or None if
+    the notebook could not be found.
+    """
+    loop = asyncio.get_running_loop()
+
+    src = nb_src.strip()
+    if not src.endswith('.ipynb') and ext is True:
+        src += '.ipynb'
+
+    if urlparse(src).scheme in ('http', 'https'):
+        try:
+            import aiohttp
+        except ImportError:
+            aiohttp = None
+
+        if aiohttp is not None:
+            if session is None:
+                async with aiohttp.ClientSession() as session:
+                    async with session.get(src) as resp:
+                        text = await resp.text()
+            else:
+                async with session.get(src) as resp:
+                    text = await resp.text()
+            return await loop.run_in_executor(executor, _reads_nb, text, src)
+
+    return await loop.run_in_executor(executor, read_nb, nb_src, ext)
+
+
+def include_sources(nb):
+    """Return the sources named by the @include cells of a notebook"""
+    return [
+        Cell.parse_include(cell.source)[0] for cell in nb.cells
+        if "@include" in cell.source
+    ]
+
+
+async def prefetch(ipynb, registry=None, executor=None):
+    """
+    Read a notebook and everything it includes, transitively, with the
+    reads at each level of the include DAG running concurrently. Each
+    notebook is read once, and notebooks already in the registry are
+    not read at all.
+
+    Returns
+    =======
+    sources: dict
+        Mapping of resolved location to notebook object, suitable for
+        the `sources` argument of NoteBook.
+    """
+    sources = {}
+    seen = set(registry or ())
+    frontier = {resolve_nb_src(ipynb) or ipynb.strip(): ipynb}
+
+    session = None
+    try:
+        import aiohttp
+        session = aiohttp.ClientSession()
+    except ImportError:
+        pass
+
+    try:
+        while frontier:
+            keys = list(frontier)
+            seen.update(keys)
+            nbs = await asyncio.gather(*[
+                aread_nb(frontier[k], executor=executor, session=session)
+                for k in keys
+            ])
+
+            frontier = {}
+            for key, nb in zip(keys, nbs):
+                if nb is None:
+                    continue
+                sources[key] = nb
+                for src in include_sources(nb):
+                    k = resolve_nb_src(src) or src.strip()
+                    if k not in seen and k not in frontier:
+                        frontier[k] = src
+    finally:
+        if session is not None:
+            await session.close()
+
+    return sources
+
+
+async def aload(ipynb, registry=None, executor=None):
+    """
+    Asynchronous NoteBook(ipynb): prefetch the include DAG concurrently,
+    then parse it on the executor.
+
+    Parameters
+    ==========
+    ipynb: String
+        Path or URL of the notebook.
+    registry: dict
+        Optional registry of parsed notebooks to share (see NoteBook).
+    executor: concurrent.futures.Executor
+        Executor for blocking and CPU-bound work. Defaults to the loop's.
+
+    Returns
+    =======
+    A NoteBook: the registry's own if the notebook is already in it.
+    """
+    if registry is None:
+        registry = {}
+
+    key = resolve_nb_src(ipynb) or ipynb.strip()
+    if key in registry:
+        return registry[key]
+
+    sources = await prefetch(ipynb, registry=registry, executor=executor)
+
+    def build():
+        with registry_lock(registry):
+            # Another load may have parsed it while this one prefetched
+            if key in registry:
+                return registry[key]
+            return NoteBook(ipynb, registry=registry, sources=sources)
+
+    return await asyncio.get_running_loop().run_in_executor(executor, build)
+
+
+async def acompile(nb, executor=None):
+    """Compile a NoteBook on the executor and return the result"""
+    return await asyncio.get_running_loop().run_in_executor(
+        executor, nb.compile)
@@ -0,0 +1,261 @@
+"""
+Collect the images and data files that atoms reference by relative
+path (e.g. atoms/os/img/Software_Carpentry.png or
+atoms/foundations/data/*.csv) into one shared asset directory, and
+rewrite the references in compiled cells to point at it.
+
+Assets are stored by content hash, so a file used by many sessions, or
+by many atoms, is materialised once; files already present are skipped.
+Hardlinks are tried first, then reflinks (copy-on-write clones, where
+the filesystem supports them), and only then a plain copy.
+"""
+
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+from urllib.parse import urlparse
+
+from .core import atomic_write
+
+MANIFEST = '.geopyter-assets.json'
+
+# Markdown images and links: ![alt](path "title") / [text](path)
+MARKDOWN_REF = re.compile(r'(!?\[[^\]]*\]\()([^)\s]+)')
+# HTML attributes: <img src="path">, <a href='path'>
+HTML_REF = re.compile(r'''((?:src|href)\s*=\s*["'])([^"']+)(?=["'])''')
+# String literals in code: pd.read_csv('data/file.csv')
+CODE_REF = re.compile(r'''(["'])([^"'\n]+\.[A-Za-z0-9]{1,6})(?=\1)''')
+
+
+def file_hash(fn, bufsize=1 << 20):
+    """Return the SHA-256 of a file, read in blocks"""
+    h = hashlib.sha256()
+    with io.open(fn, 'rb') as f:
+        for block in iter(lambda: f.read(bufsize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def reflink(s, d):
+    """Clone open file s into d with FICLONE (Linux; btrfs, XFS, ...)"""
+    import fcntl
+    FICLONE = 0x40049409
+    fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+def materialize(src, dst):
+    """Put a copy of src at dst as cheaply as the filesystem allows"""
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    try:
+        os.link(src, dst)  # Atomic in itself
+        return
+    except FileExistsError:
+        return  # Asset paths are named by content, so it is the same file
+    except OSError:
+        pass
+    with io.open(src, 'rb') as s, atomic_write(dst) as d:
+        try:
+            reflink(s, d)
+        except (OSError, ImportError):
+            shutil.copyfileobj(s, d)
+
+
+class AssetStore(object):
+    """
+    A directory of assets named by content hash.
+
+    A manifest in the directory remembers the hash of every source file
+    by (mtime, size), so unchanged datasets are not re-read on every
+    build.
+
+    Parameters
+    ==========
+    assets_dir: String
+        The shared asset directory, e.g. 'builds/assets'.
+    materialize: boolean
+        If False nothing is written: add() only records which source
+        file belongs at each asset path (in `files`), e.g. so that a
+        bundle can stream the assets straight from their sources.
+    """
+
+    def __init__(self, assets_dir, materialize=True):
+        self.assets_dir = assets_dir
+        self.materialize = materialize
+        self.files = {}  # Asset path -> source file
+        self.manifest = {}
+        self._dirty = False
+        fn = os.path.join(assets_dir, MANIFEST)
+        if materialize and os.path.exists(fn):
+            with io.open(fn, 'r', encoding='utf8') as f:
+                self.manifest = json.load(f)
+
+    def hash(self, fn):
+        st = os.stat(fn)
+        entry = self.manifest.get(fn)
+        if entry and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+            return entry[2]
+        digest = file_hash(fn)
+        self.manifest[fn] = [st.st_mtime_ns, st.st_size, digest]
+        self._dirty = True
+        return digest
+
+    def add(self, fn):
+        """Store a file (once) and return its path in the store"""
+        fn = os.path.abspath(fn)
+        digest = self.hash(fn)
+        dst = os.path.join(self.assets_dir, digest[:16], os.path.basename(fn))
+        self.files[dst] = fn
+        if self.materialize and not os.path.exists(dst):
+            print("Adding asset: " + fn)
+            materialize(fn, dst)
+        return dst
+
+    def save(self):
+        if self._dirty and self.materialize:
+            with atomic_write(os.path.join(self.assets_dir, MANIFEST),
+                              'w') as f:
+                json.dump(self.manifest, f, indent=1, sort_keys=True)
+            self._dirty = False
+
+
+def local_asset(ref, base_dir):
+    """
+    Return the file a relative reference points at from base_dir, or
+    None if it is not a reference to an existing local file.
+    """
+    path = ref.split('#', 1)[0].split('?', 1)[0]
+    if not path or urlparse(path).scheme or os.path.isabs(path):
+        return None
+    if path.endswith('.ipynb'):
+        return None
+    fn = os.path.normpath(os.path.join(base_dir, path))
+    return fn if os.path.isfile(fn) else None
+
+
+def bundle_assets(nb, out_fn, assets_dir, store=None):
+    """
+    Find relative asset references in a compiled notebook, add the
+    files to the asset store and point the references at them.
+
+    Each cell's references are resolved against the directory of the
+    notebook the cell came from (recorded by NoteBook in the cell's
+    geopyter 'source' metadata, relative to the base directory). Cells
+    from remote sources are left as they are.
+
+    Parameters
+    ==========
+    nb: nbformat.notebooknode.NotebookNode
+        The compiled notebook. It is not modified.
+    out_fn: String
+        Where the notebook will be written; rewritten references are
+        relative to its directory.
+    assets_dir: String
+        The shared asset directory.
+    store: AssetStore
+        Optional store to reuse across notebooks.
+
+    Returns
+    =======
+    nb: nbformat.notebooknode.NotebookNode
+        A copy of the notebook with rewritten references (cells without
+        references are shared with the original).
+    """
+    from .core import is_remote, local_path
+
+    own_store = store is None
+    if own_store:
+        store = AssetStore(assets_dir)
+
+    out_dir = os.path.dirname(os.path.abspath(out_fn))
+
+    def base_dir(cell):
+        src = cell.get('metadata', {}).get('geopyter', {}).get('source')
+        if not src or is_remote(src):
+            return None
+        return os.path.dirname(local_path(src))
+
+    new = rewrite_refs(nb, base_dir, store.add, out_dir)
+
+    if own_store:
+        store.save()
+    return new
+
+
+def relocate_refs(nb, from_dir, to_dir):
+    """
+    Rewrite the relative references of a notebook that resolve from
+    from_dir (e.g. to files collected by bundle_assets) to resolve from
+    to_dir instead, for cells moved to a notebook there.
+
+    Returns
+    =======
+    nb: nbformat.notebooknode.NotebookNode
+        A copy of the notebook with rewritten references (cells without
+        references are shared with the original).
+    """
+    from_dir = os.path.abspath(from_dir)
+    return rewrite_refs(nb, lambda cell: from_dir, lambda fn: fn,
+                        os.path.abspath(to_dir))
+
+
+def rewrite_refs(nb, base_dir, replace, out_dir):
+    """
+    Rewrite the relative references to local files in a notebook.
+
+    Parameters
+    ==========
+    nb: nbformat.notebooknode.NotebookNode
+        The notebook. It is not modified.
+    base_dir: function
+        Return the directory a cell's references resolve from, or None
+        to leave the cell as it is.
+    replace: function
+        Return the file a reference should point at instead, given the
+        file it points at now.
+    out_dir: String
+        The directory new references are relative to.
+
+    Returns
+    =======
+    nb: nbformat.notebooknode.NotebookNode
+        A copy of the notebook (cells without references are shared with
+        the original).
+    """
+    from .core import copy_cell
+
+    def rewrite(pattern, source, cell_dir):
+
+        def sub(m):
+            fn = local_asset(m.group(2), cell_dir)
+            if fn is None:
+                return m.group(0)
+            rel = os.path.relpath(replace(fn), out_dir).replace(os.sep, '/')
+            return m.group(1) + rel
+
+        return pattern.sub(sub, source)
+
+    cells = []
+    for cell in nb.cells:
+        cell_dir = base_dir(cell)
+        if cell_dir is None:
+            cells.append(cell)
+            continue
+
+        source = cell.source
+        if cell.cell_type == 'markdown':
+            source = rewrite(MARKDOWN_REF, source, cell_dir)
+            source = rewrite(HTML_REF, source, cell_dir)
+        elif cell.cell_type == 'code':
+            source = rewrite(CODE_REF, source, cell_dir)
+
+        if source != cell.source:
+            cell = copy_cell(cell)
+            cell['source'] = source
+        cells.append(cell)
+
+    new = type(nb)(nb)
+    new['cells'] = cells
+    return new
@@ -0,0 +1,387 @@
+"""
+Package a course for distribution as a single archive, in one pass:
+compiled notebooks are streamed straight from the compose step and
+assets straight from their source files, without writing builds/ first.
+
+    bundle_course(['sessions/s1.ipynb', 'sessions/s2.ipynb'], 'course.zip')
+
+The archive holds one <session>.ipynb per session at the top level and
+the (deduplicated) files they reference under assets/<hash>/, with the
+references rewritten to match (see geopyter.assets).
+
+Zip archives are written by a small writer of our own so that members
+can be deflated in parallel, each into a spooled temporary file, with
+only a bounded window of them in flight at once; and so that members
+whose content is unchanged since the previous bundle can have their
+compressed bytes copied across rather than compressed again. Entries
+get a fixed timestamp, so bundling unchanged sources gives an
+identical archive. '.tar.zst' archives are streamed through zstandard
+(optional: pip install zstandard), which compresses on its own worker
+threads.
+"""
+
+import io
+import os
+import re
+import struct
+import tarfile
+import tempfile
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from .core import atomic_write
+
+# Zip record layouts (see the PKWARE APPNOTE)
+LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+CENTRAL_HEADER = struct.Struct('<4s6H3L5H2L')
+END_RECORD = struct.Struct('<4s4H2LH')
+
+UTF8_FLAG = 0x0800
+DOS_EPOCH = (0, (1 << 5) | 1)  # 1980-01-01 00:00:00 as DOS (time, date)
+ZIP_LIMIT = 0xFFFFFFFF  # Zip64 is not supported
+SPOOL_SIZE = 8 << 20  # Compressed members larger than this spill to disk
+
+
+class Member(object):
+    """A compressed archive member, ready to be copied into place"""
+
+    __slots__ = ('name', 'method', 'crc', 'size', 'data', 'reused')
+
+    def __init__(self, name, method, crc, size, data, reused=False):
+        self.name = name
+        self.method = method
+        self.crc = crc
+        self.size = size
+        self.data = data  # A file object holding the compressed bytes
+        self.reused = reused
+
+    @property
+    def compressed_size(self):
+        self.data.seek(0, io.SEEK_END)
+        return self.data.tell()
+
+
+def iter_chunks(source, bufsize=1 << 20):
+    """Yield the content of a member given as bytes or as a file path"""
+    if isinstance(source, bytes):
+        for i in range(0, len(source), bufsize):
+            yield source[i:i + bufsize]
+        return
+    with io.open(source, 'rb') as f:
+        for block in iter(lambda: f.read(bufsize), b''):
+            yield block
+
+
+def member_crc(source):
+    crc, size = 0, 0
+    for block in iter_chunks(source):
+        crc = zlib.crc32(block, crc)
+        size += len(block)
+    return crc, size
+
+
+def previous_members(fn):
+    """
+    Index the members of an existing zip by name, or return {} if there
+    is no usable previous bundle.
+    """
+    if not fn or not os.path.exists(fn):
+        return {}
+    try:
+        with zipfile.ZipFile(fn) as z:
+            return {
+                info.filename: info
+                for info in z.infolist()
+                if info.compress_type in (zipfile.ZIP_STORED,
+                                          zipfile.ZIP_DEFLATED)
+            }
+    except (zipfile.BadZipFile, OSError):
+        return {}
+
+
+def copy_raw(fn, info, out):
+    """Copy the compressed bytes of a zip member to the file object out"""
+    with io.open(fn, 'rb') as f:
+        f.seek(info.header_offset)
+        header = LOCAL_HEADER.unpack(f.read(LOCAL_HEADER.size))
+        f.seek(header[-2] + header[-1], io.SEEK_CUR)  # Name and extra field
+        remaining = info.compress_size
+        while remaining:
+            block = f.read(min(remaining, 1 << 20))
+            if not block:
+                raise zipfile.BadZipFile("Truncated member: " + info.filename)
+            out.write(block)
+            remaining -= len(block)
+
+
+def compress_member(name, source, level=6, previous=None, previous_fn=None):
+    """
+    Compress one member (bytes or a file path), or copy its compressed
+    bytes from the previous bundle if the content there is the same.
+
+    Returns
+    =======
+    A Member.
+    """
+    old = (previous or {}).get(name)
+    if old is not None:
+        crc, size = member_crc(source)
+        if crc == old.CRC and size == old.file_size:
+            data = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+            copy_raw(previous_fn, old, data)
+            return Member(name, old.compress_type, crc, size, data, True)
+
+    crc, size = 0, 0
+    data = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    deflate = zlib.compressobj(level, zlib.DEFLATED, -15)  # Raw deflate
+    for block in iter_chunks(source):
+        crc = zlib.crc32(block, crc)
+        size += len(block)
+        data.write(deflate.compress(block))
+    data.write(deflate.flush())
+
+    # Already-compressed files (PNG, JPEG, zip) can come out larger
+    if data.tell() >= size:
+        data.close()
+        data = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        for block in iter_chunks(source):
+            data.write(block)
+        return Member(name, zipfile.ZIP_STORED, crc, size, data)
+
+    return Member(name, zipfile.ZIP_DEFLATED, crc, size, data)
+
+
+class ZipBundle(object):
+    """
+    A write-only zip archive that members are appended to in order.
+
+    Parameters
+    ==========
+    f: file object
+        Binary file object to write to.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.entries = []
+        self.offset = 0
+
+    def add(self, member):
+        name = member.name.encode('utf8')
+        csize = member.compressed_size
+        if max(csize, member.size, self.offset) > ZIP_LIMIT:
+            raise ValueError("Bundle too large for a zip without Zip64: " +
+                             member.name)
+
+        self.f.write(
+            LOCAL_HEADER.pack(b'PK\x03\x04', 20, UTF8_FLAG, member.method,
+                              DOS_EPOCH[0], DOS_EPOCH[1], member.crc, csize,
+                              member.size, len(name), 0))
+        self.f.write(name)
+        member.data.seek(0)
+        for block in iter(lambda: member.data.read(1 << 20), b''):
+            self.f.write(block)
+        member.data.close()
+
+        self.entries.append((name, member.method, member.crc, csize,
+                             member.size, self.offset))
+        self.offset += LOCAL_HEADER.size + len(name) + csize
+
+    def close(self):
+        if len(self.entries) > 0xFFFF:
+            raise ValueError("Too many members for a zip without Zip64")
+
+        start = self.offset
+        for name, method, crc, csize, size, offset in self.entries:
+            record = CENTRAL_HEADER.pack(b'PK\x01\x02', (3 << 8) | 20, 20,
+                                         UTF8_FLAG, method, DOS_EPOCH[0],
+                                         DOS_EPOCH[1], crc, csize, size,
+                                         len(name), 0, 0, 0, 0,
+                                         0o100644 << 16, offset)
+            self.f.write(record)
+            self.f.write(name)
+            self.offset += len(record) + len(name)
+
+        if self.offset > ZIP_LIMIT:
+            raise ValueError("Bundle too large for a zip without Zip64")
+        self.f.write(
+            END_RECORD.pack(b'PK\x05\x06', 0, 0, len(self.entries),
+                            len(self.entries), self.offset - start, start, 0))
+
+
+def write_zip(members, fn, level=6, max_workers=None, reuse=True):
+    """
+    Write (name, bytes or path) pairs to a zip file, compressing on a
+    thread pool (zlib releases the GIL) with at most a few members per
+    worker in flight, so memory stays bounded however large the course.
+
+    Returns
+    =======
+    stats: dict
+        Counts of 'compressed' and 'reused' members.
+    """
+    previous = previous_members(fn) if reuse else {}
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    window = 2 * max_workers
+
+    stats = {'compressed': 0, 'reused': 0}
+    with atomic_write(fn) as f, \
+            ThreadPoolExecutor(max_workers=max_workers) as pool:
+        archive = ZipBundle(f)
+        pending = []
+
+        def drain(n):
+            while len(pending) > n:
+                member = pending.pop(0).result()
+                stats['reused' if member.reused else 'compressed'] += 1
+                archive.add(member)
+
+        for name, source in members:
+            pending.append(
+                pool.submit(compress_member, name, source, level, previous,
+                            fn))
+            drain(window)
+        drain(0)
+        archive.close()
+
+    return stats
+
+
+def write_tar_zst(members, fn, level=10, max_workers=None):
+    """
+    Stream (name, bytes or path) pairs into a zstandard-compressed tar.
+    A tar.zst is one compressed stream, so members cannot be reused from
+    a previous bundle; zstd compresses on max_workers threads instead.
+    """
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError(
+            "Bundling as .tar.zst requires zstandard: pip install zstandard")
+
+    cctx = zstandard.ZstdCompressor(level=level,
+                                    threads=max_workers or -1)
+    count = 0
+    with atomic_write(fn) as f, \
+            cctx.stream_writer(f, closefd=False) as z, \
+            tarfile.open(fileobj=z, mode='w|',
+                         format=tarfile.PAX_FORMAT) as tar:
+        for name, source in members:
+            info = tarfile.TarInfo(name)
+            info.mode = 0o644
+            if isinstance(source, bytes):
+                info.size = len(source)
+                tar.addfile(info, io.BytesIO(source))
+            else:
+                info.size = os.path.getsize(source)
+                with io.open(source, 'rb') as s:
+                    tar.addfile(info, s)
+            count += 1
+
+    return {'compressed': count, 'reused': 0}
+
+
+def course_members(sessions, variants=None, registry=None):
+    """
+    Compile sessions one at a time and yield archive members: each
+    compiled notebook as (name, bytes), with its asset references
+    rewritten, and then every asset they use, once, as (name, path).
+
+    Parameters
+    ==========
+    sessions: list of String
+        Paths or URLs of the session notebooks.
+    variants: list of Variant
+        If given, each session contributes <session>-<variant>.ipynb
+        for every variant rather than a single <session>.ipynb.
+    registry: dict
+        Optional registry of parsed notebooks to share (see NoteBook).
+    """
+    from .assets import AssetStore, bundle_assets
+    from .core import NoteBook, Variant
+    from .validate import writes_nb
+
+    if registry is None:
+        registry = {}
+
+    # Lay the archive out under a directory that is never written to;
+    # the store only records which source file each asset path maps to
+    root = os.path.abspath('.geopyter-bundle')
+    store = AssetStore(os.path.join(root, 'assets'), materialize=False)
+
+    for session in sessions:
+        nb = NoteBook(session, registry=registry)
+        stem = re.sub(r'(?:\.ipynb)?$',
+                      '',
+                      os.path.basename(nb.nb_path),
+                      count=1)
+
+        if variants:
+            compiled = nb.compile_variants(variants)
+            names = [(stem + '-' + v.name + '.ipynb', compiled[v.name])
+                     for v in variants]
+        else:
+            names = [(stem + '.ipynb', nb.compile_variants(
+                [Variant('compiled')])['compiled'])]
+
+        for name, compiled in names:
+            compiled = bundle_assets(compiled, os.path.join(root, name),
+                                     store.assets_dir, store)
+            yield name, writes_nb(compiled, nb_src=name).encode('utf8')
+
+    for dst in sorted(store.files):
+        yield os.path.relpath(dst, root).replace(os.sep, '/'), store.files[dst]
+
+
+def bundle_course(sessions,
+                  out_fn,
+                  variants=None,
+                  level=None,
+                  max_workers=None,
+                  reuse=True):
+    """
+    Compile sessions and write them, with their assets, to one archive.
+
+    Parameters
+    ==========
+    sessions: list of String
+        Paths or URLs of the session notebooks.
+    out_fn: String
+        The archive to write; '.zip' or '.tar.zst'.
+    variants: list of Variant
+        Optional course variants to bundle (see course_members).
+    level: int
+        Compression level. Defaults to 6 for zip and 10 for zstd.
+    max_workers: int
+        Compression threads. Defaults to the number of CPUs.
+    reuse: boolean
+        Copy members that are unchanged since the previous zip at out_fn
+        rather than compressing them again.
+
+    Returns
+    =======
+    stats: dict
+        Counts of 'compressed' and 'reused' members.
+    """
+    members = course_members(sessions, variants=variants)
+
+    if out_fn.endswith('.zip'):
+        stats = write_zip(members,
+                          out_fn,
+                          level=6 if level is None else level,
+                          max_workers=max_workers,
+                          reuse=reuse)
+    elif out_fn.endswith(('.tar.zst', '.tzst')):
+        stats = write_tar_zst(members,
+                              out_fn,
+                              level=10 if level is None else level,
+                              max_workers=max_workers)
+    else:
+        raise ValueError("Unknown bundle format '" + out_fn +
+                         "' (expected .zip or .tar.zst)")
+
+    print("Bundled " + out_fn + ": " + str(stats['compressed']) +
+          " compressed, " + str(stats['reused']) + " reused")
+    return stats
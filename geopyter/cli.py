@@ -0,0 +1,332 @@
+"""
+The `geopyter` command line interface.
+
+Only the standard library is imported up front: `inspect` and `strip`
+work on the raw notebook JSON so that they start quickly enough to be
+run per file from pre-commit hooks, and `build` imports the compiler
+(and with it nbformat and GitPython) only when it runs.
+"""
+
+import argparse
+import io
+import json
+import os
+import re
+import sys
+
+
+def load_json(path):
+    """Read a notebook as plain JSON, without nbformat or validation"""
+    with io.open(path, 'r', encoding='utf8') as f:
+        return json.load(f)
+
+
+def dump_json(nb, path):
+    """Write plain notebook JSON laid out the way nbformat writes it"""
+    with io.open(path, 'w', encoding='utf8') as f:
+        f.write(json.dumps(nb, sort_keys=True, indent=1, ensure_ascii=False))
+        f.write('\n')
+
+
+def source_of(cell):
+    src = cell.get('source', '')
+    if isinstance(src, list):
+        src = ''.join(src)
+    return src
+
+
+def outline(nb):
+    """
+    Return the outline of a notebook (headers and includes) as a list
+    of (cell index, depth, text) tuples.
+    """
+    from .core import header_levels
+
+    rows = []
+    depth = 0
+    for i, cell in enumerate(nb.get('cells', [])):
+        src = source_of(cell)
+        if '@include' in src:
+            m = re.search(r'src\s*=\s*(.+)', src)
+            sel = re.search(r'select\s*=\s*(.+)', src)
+            text = '@include ' + (m.group(1).strip() if m else '?')
+            if sel:
+                text += ' [' + sel.group(1).strip() + ']'
+            rows.append((i, depth + 1, text))
+        elif cell.get('cell_type') == 'markdown' and header_levels(src):
+            for l in src.splitlines():
+                m = re.match('(#{1,4}) (.+)', l)
+                if m:
+                    depth = len(m.group(1))
+                    rows.append((i, depth, m.group(0)))
+    return rows
+
+
+def cmd_inspect(args):
+    for path in args.notebooks:
+        nb = load_json(path)
+        print(path + ' (' + str(len(nb.get('cells', []))) + ' cells)')
+        for i, depth, text in outline(nb):
+            print('{0:>5} {1}{2}'.format('[' + str(i) + ']',
+                                         '  ' * (depth - 1), text))
+    return 0
+
+
+def cmd_strip(args):
+    """Clear outputs and execution counts; exit 1 if anything changed"""
+    changed = False
+    for path in args.notebooks:
+        nb = load_json(path)
+        dirty = False
+        for cell in nb.get('cells', []):
+            if cell.get('cell_type') != 'code':
+                continue
+            if cell.get('outputs') or cell.get('execution_count') is not None:
+                cell['outputs'] = []
+                cell['execution_count'] = None
+                dirty = True
+        if dirty:
+            changed = True
+            print('Stripped: ' + path)
+            if not args.check:
+                dump_json(nb, path)
+    return 1 if changed else 0
+
+
+def cmd_build(args):
+    from .core import NoteBook, Variant, VARIANTS
+
+    variants = [Variant('compiled')]
+    if args.variant:
+        names = set(args.variant)
+        variants = [v for v in VARIANTS if v.name in names]
+        unknown = names - set(v.name for v in variants)
+        if unknown:
+            print('Unknown variant(s): ' + ', '.join(sorted(unknown)),
+                  file=sys.stderr)
+            return 2
+
+    registry = {}  # Shared, so atoms used by several sessions parse once
+    builds = []  # (output stem, session, compiled notebook)
+    for session in args.sessions:
+        nb = NoteBook(session, registry=registry)
+        stem = re.sub(r'(?:\.ipynb)?$', '', os.path.basename(session), count=1)
+
+        if args.full:
+            compiled = nb.compile_variants(variants)
+        else:
+            # Patch the previous build, re-expanding only changed atoms
+            compiled = nb.compile_incremental(variants)
+
+        # Each variant goes through the same stages as a plain build
+        for name, notebook in compiled.items():
+            builds.append((stem + '-' + name if args.variant else stem, nb,
+                           notebook))
+
+    if args.assets or args.execute:
+        # Cells read data relative to the atom they came from, so the
+        # files are collected and the references pointed at them before
+        # anything runs; notebooks then work from the output directory
+        from .assets import AssetStore, bundle_assets
+
+        store = AssetStore(os.path.join(args.out_dir, 'assets'))
+        builds = [(stem, nb,
+                   bundle_assets(compiled,
+                                 os.path.join(args.out_dir, stem + '.ipynb'),
+                                 store.assets_dir, store))
+                  for stem, nb, compiled in builds]
+        store.save()
+
+    if args.execute:
+        # All notebooks at once, on a bounded pool of kernels
+        from .execute import execute_notebooks
+
+        cwd = os.path.abspath(args.out_dir)
+        os.makedirs(cwd, exist_ok=True)
+        executed = execute_notebooks(
+            dict((stem, compiled) for stem, nb, compiled in builds),
+            max_kernels=args.jobs,
+            cwds=dict((stem, cwd) for stem, nb, compiled in builds))
+        builds = [(stem, nb, executed[stem]) for stem, nb, _ in builds]
+
+    if args.max_image_size:
+        from .images import optimize_images
+
+        builds = [(stem, nb,
+                   optimize_images(compiled,
+                                   max_size=args.max_image_size,
+                                   quality=args.image_quality,
+                                   max_workers=args.jobs))
+                  for stem, nb, compiled in builds]
+
+    for stem, nb, compiled in builds:
+        if args.shard_level:
+            nb.write_shards(out_dir=args.out_dir,
+                            level=args.shard_level,
+                            max_workers=args.jobs,
+                            nb=compiled,
+                            stem=stem,
+                            strict=args.strict)
+        else:
+            nb.write(os.path.join(args.out_dir, stem + '.ipynb'),
+                     nb=compiled,
+                     strict=args.strict)
+
+    if args.export:
+        from .export import export_notebooks
+
+        export_notebooks(dict((stem, compiled)
+                              for stem, nb, compiled in builds),
+                         formats=args.export,
+                         out_dir=args.out_dir,
+                         max_workers=args.jobs)
+    return 0
+
+
+def cmd_validate(args):
+    """Check notebooks against the nbformat schema; exit 1 if any fail"""
+    from .validate import validate_notebooks
+
+    errors = validate_notebooks(args.notebooks)
+    for path in args.notebooks:
+        if path in errors:
+            print('Invalid: ' + path + ': ' + errors[path])
+    return 1 if errors else 0
+
+
+def cmd_bundle(args):
+    from .bundle import bundle_course
+    from .core import VARIANTS
+
+    variants = None
+    if args.variant:
+        variants = [v for v in VARIANTS if v.name in set(args.variant)]
+    bundle_course(args.sessions,
+                  args.output,
+                  variants=variants,
+                  level=args.level,
+                  max_workers=args.jobs,
+                  reuse=not args.no_reuse)
+    return 0
+
+
+def cmd_serve(args):
+    from .server import serve
+
+    serve(root=args.root, host=args.host, port=args.port)
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='geopyter',
+        description='Compose and manage GeoPyTeR teaching notebooks.')
+    sub = parser.add_subparsers(dest='command')
+    sub.required = True
+
+    p = sub.add_parser('build', help='compile session notebooks')
+    p.add_argument('sessions', nargs='+', help='session notebooks')
+    p.add_argument('-o',
+                   '--out-dir',
+                   default='builds',
+                   help='output directory (default: builds)')
+    p.add_argument('--variant',
+                   action='append',
+                   help='write this course variant (repeatable)')
+    p.add_argument('--full',
+                   action='store_true',
+                   help='compile from scratch rather than patching the '
+                   'previous build of each session')
+    p.add_argument('--assets',
+                   action='store_true',
+                   help='collect referenced images and data into '
+                   'OUT_DIR/assets')
+    p.add_argument('--execute',
+                   action='store_true',
+                   help='execute the compiled notebooks in OUT_DIR (implies '
+                   '--assets, so that the data they read is there)')
+    p.add_argument('--strict',
+                   action='store_true',
+                   help='fail, rather than warn, if a compiled notebook is '
+                   'invalid against the nbformat schema')
+    p.add_argument('--max-image-size',
+                   type=int,
+                   metavar='PX',
+                   help='downsample embedded images to at most PX pixels '
+                   'wide and high, and recompress them (needs Pillow)')
+    p.add_argument('--image-quality',
+                   type=int,
+                   default=85,
+                   help='JPEG quality for --max-image-size (default: 85)')
+    p.add_argument('--shard-level',
+                   type=int,
+                   choices=[1, 2, 3, 4],
+                   metavar='LEVEL',
+                   help='write each notebook as an index and one notebook '
+                   'per section, splitting at headers of this level and '
+                   'above')
+    p.add_argument('--export',
+                   action='append',
+                   choices=['html', 'slides', 'markdown', 'latex'],
+                   help='also export to this format (repeatable)')
+    p.add_argument('-j',
+                   '--jobs',
+                   type=int,
+                   default=None,
+                   help='worker processes for exporting and images, and '
+                   'kernels for --execute')
+    p.set_defaults(func=cmd_build)
+
+    p = sub.add_parser('bundle',
+                       help='compile sessions into one .zip or .tar.zst')
+    p.add_argument('sessions', nargs='+', help='session notebooks')
+    p.add_argument('-o',
+                   '--output',
+                   default='course.zip',
+                   help='archive to write (default: course.zip)')
+    p.add_argument('--variant',
+                   action='append',
+                   choices=['student', 'instructor', 'slides'],
+                   help='bundle this course variant (repeatable)')
+    p.add_argument('--level', type=int, help='compression level')
+    p.add_argument('--no-reuse',
+                   action='store_true',
+                   help='recompress every member of an existing zip')
+    p.add_argument('-j',
+                   '--jobs',
+                   type=int,
+                   default=None,
+                   help='compression threads')
+    p.set_defaults(func=cmd_bundle)
+
+    p = sub.add_parser('strip', help='remove outputs from notebooks')
+    p.add_argument('notebooks', nargs='+')
+    p.add_argument('--check',
+                   action='store_true',
+                   help="report notebooks with outputs but don't modify them")
+    p.set_defaults(func=cmd_strip)
+
+    p = sub.add_parser('validate',
+                       help='check notebooks against the nbformat schema')
+    p.add_argument('notebooks', nargs='+')
+    p.set_defaults(func=cmd_validate)
+
+    p = sub.add_parser('inspect', help='print the outline of notebooks')
+    p.add_argument('notebooks', nargs='+')
+    p.set_defaults(func=cmd_inspect)
+
+    p = sub.add_parser('serve', help='serve compiled sessions over HTTP')
+    p.add_argument('root',
+                   nargs='?',
+                   default='.',
+                   help='course directory (default: .)')
+    p.add_argument('--host', default='127.0.0.1')
+    p.add_argument('--port', type=int, default=8000)
+    p.set_defaults(func=cmd_serve)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.func(args)
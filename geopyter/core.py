@@ -1,17 +1,25 @@
 __author__ = "Jonathan Reades and Serge Rey"
 
-import nbformat
+import copy
+import hashlib
 import os
 import io
 import re
-import requests
+import json
 import importlib
-from git import Repo
-from git import InvalidGitRepositoryError
+import tempfile
+from array import array
 from collections import defaultdict
+from contextlib import contextmanager
 from datetime import datetime
+from functools import partial
 from urllib.parse import urlparse
 
+# nbformat, requests and GitPython are imported where they are used:
+# together they dominate import time (GitPython also probes for the git
+# executable), and short CLI commands such as `geopyter inspect` never
+# need them.
+
 
 def get_base_dir(base_dir='.'):
     "Get base directory"
@@ -22,6 +30,207 @@ def get_base_dir(base_dir='.'):
     return base_dir
 
 
+def is_remote(nb_src):
+    return nb_src.startswith('git+') or \
+        urlparse(nb_src).scheme in ('http', 'ftp', 'https')
+
+
+def portable_path(key):
+    """
+    Return a notebook key as recorded in compiled notebooks: local paths
+    relative to the base directory, with '/' separators, so that
+    compiled cells, their hashes and the provenance map do not depend on
+    where the course is checked out. Remote sources are unchanged.
+    """
+    if is_remote(key):
+        return key
+    return os.path.relpath(key, os.path.abspath(get_base_dir())).replace(
+        os.sep, '/')
+
+
+def local_path(src):
+    """Return the notebook key for a path recorded by portable_path"""
+    if is_remote(src):
+        return src
+    return os.path.normpath(
+        os.path.join(os.path.abspath(get_base_dir()), src))
+
+
+def get_cache_dir(name, cache_dir=None):
+    """
+    Return a named subdirectory of the geopyter cache.
+
+    Parameters
+    ==========
+    name: String
+        Subdirectory for one kind of cached data (e.g. 'outputs').
+    cache_dir: String
+        Cache root. Defaults to $GEOPYTER_CACHE, or ~/.cache/geopyter.
+
+    Returns
+    =======
+    path: String
+    """
+    if cache_dir is None:
+        cache_dir = os.environ.get(
+            'GEOPYTER_CACHE',
+            os.path.join(os.path.expanduser('~'), '.cache', 'geopyter'))
+    return os.path.join(cache_dir, name)
+
+
+# Files created by atomic_write get the usual permissions, not mkstemp's
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+@contextmanager
+def atomic_write(fn, mode='wb'):
+    """
+    Open a new temporary file beside fn for writing and, once the block
+    completes, move it into place; on error it is removed instead. The
+    temporary name is unique, so neither readers nor other writers (in
+    this process or another) ever see a partly written fn.
+
+    Parameters
+    ==========
+    fn: String
+        The file to write. Missing directories are created.
+    mode: String
+        'wb', or 'w' for UTF-8 text.
+    """
+    parent = os.path.dirname(os.path.abspath(fn))
+    os.makedirs(parent, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(fn) + '.',
+                               suffix='.tmp',
+                               dir=parent)
+    try:
+        with io.open(fd, mode, encoding=None if 'b' in mode else 'utf8') as f:
+            yield f
+        os.chmod(tmp, 0o666 & ~_UMASK)
+        os.replace(tmp, fn)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class DiskCache(object):
+    """
+    Values stored on disk under the geopyter cache, one file per key.
+    Keys are hex digests; files are spread over subdirectories named by
+    the first two characters, and written with atomic_write, so builds
+    running side by side can share the cache. Subclasses set `name`
+    (the cache subdirectory, see get_cache_dir) and convert their
+    values to and from bytes.
+
+    Parameters
+    ==========
+    cache_dir: String
+        Cache root. Defaults to $GEOPYTER_CACHE, or ~/.cache/geopyter.
+    """
+
+    name = None
+    suffix = ''
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = get_cache_dir(self.name, cache_dir)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + self.suffix)
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def read(self, key):
+        """Return the bytes stored for a key; KeyError if there are none"""
+        try:
+            with io.open(self.path(key), 'rb') as f:
+                return f.read()
+        except (IOError, OSError):
+            raise KeyError(key)
+
+    def write(self, key, data):
+        with atomic_write(self.path(key)) as f:
+            f.write(data)
+
+
+class CompiledCache(DiskCache):
+    """
+    The notebooks compiled for each session and variant by the previous
+    build, as they were before any later stage (execution, assets,
+    images), for NoteBook.patch to bring up to date.
+    """
+
+    name = 'compiled'
+    suffix = '.ipynb'
+
+    @staticmethod
+    def key(nb, variant):
+        from . import __version__
+
+        return hashlib.sha256('\0'.join(
+            [__version__, portable_path(nb.key),
+             variant]).encode('utf8')).hexdigest()
+
+    def get(self, key):
+        """Return the notebook stored for a key, or None"""
+        import nbformat
+
+        try:
+            return nbformat.from_dict(json.loads(self.read(key).decode('utf8')))
+        except KeyError:
+            return None
+
+    def put(self, key, nb):
+        self.write(key, json.dumps(nb, sort_keys=True).encode('utf8'))
+
+
+class IncludeCycleError(ValueError):
+    """Raised when a chain of @include cells leads back to a notebook
+    that is already being loaded. The `cycle` attribute holds the
+    sequence of notebook locations that form the loop."""
+
+    def __init__(self, cycle):
+        self.cycle = tuple(cycle)
+        super(IncludeCycleError, self).__init__(
+            "Cyclic @include detected: " + " -> ".join(self.cycle))
+
+
+def resolve_nb_src(nb_src, ext=True):
+    """
+    Resolve a notebook reference to the location that read_nb
+    would actually read it from.
+
+    Parameters
+    ==========
+    nb_src: String
+        Path or URL of the notebook, as written in an @include.
+    ext: boolean
+        Append '.ipynb' if missing (see read_nb).
+
+    Returns
+    =======
+    loc: String
+        The URL unchanged, or the normalised absolute path of the
+        first candidate file that exists. None if nothing was found.
+    """
+    nb_src = nb_src.strip()
+    if not nb_src.endswith('.ipynb') and ext is True:
+        nb_src += '.ipynb'
+
+    if urlparse(nb_src).scheme in ('http', 'ftp', 'https'):
+        return nb_src
+
+    if nb_src.startswith('git+'):
+        return nb_src
+
+    for candidate in (nb_src, os.path.join(get_base_dir(), "atoms", nb_src)):
+        if os.path.exists(candidate):
+            return os.path.normpath(os.path.abspath(candidate))
+
+    return None
+
+
 def read_nb(nb_src, ext=True):
     """
     Read a notebook file and return a notebook object.
@@ -31,7 +240,9 @@ def read_nb(nb_src, ext=True):
     nb: String
         Path to the notebook file; if the path does not end
         in '.ipynb' then this will be appended unless you
-        override this by setting the 'ext' to False.
+        override this by setting the 'ext' to False. Sources of the
+        form 'git+<repo>@<ref>:<path>' are read from a local mirror
+        of the repository (see geopyter.mirror).
     ext: boolean
         Defaults to True, meaning that the '.ipynb'
         extension will be automatically added. If you do not
@@ -42,6 +253,10 @@ def read_nb(nb_src, ext=True):
     An object of class nbformat.notebooknode.NotebookNode
     """
 
+    # Parsed without nbformat's implicit validation, which is done
+    # (once per content) by geopyter.validate instead
+    from .validate import reads_nb
+
     # Append file extension if missing and ext is True
     if not nb_src.endswith('.ipynb') and ext is True:
         nb_src += '.ipynb'
@@ -49,20 +264,23 @@ def read_nb(nb_src, ext=True):
     nb = None
 
     loc = urlparse(nb_src)
-    if loc.scheme in ('http', 'ftp', 'https'):
+    if nb_src.startswith('git+'):
+        from .mirror import read_git_src
+        nbd, sha = read_git_src(nb_src)
+        nb = reads_nb(nbd, nb_src)
+
+    elif loc.scheme in ('http', 'ftp', 'https'):
         # This doesn't support credentialed access at this time
         # -- partly because it's a pain, and partly because you
         # should be sharing and making things open... :-)
+        import requests
         nbd = requests.get(nb_src).text
-
-        # Read-only in UTF-8, note NO_CONVERT.
-        with io.StringIO(nbd) as f:
-            nb = nbformat.read(f, nbformat.NO_CONVERT)
+        nb = reads_nb(nbd, nb_src)
 
     elif os.path.exists(nb_src):
         # Read-only in UTF-8, note NO_CONVERT.
         with open(nb_src, 'r', encoding='utf8') as f:
-            nb = nbformat.read(f, nbformat.NO_CONVERT)
+            nb = reads_nb(f.read(), nb_src)
 
     elif os.path.exists(os.path.join(get_base_dir(), "atoms", nb_src)):
         # Read-only in UTF-8, note NO_CONVERT.
@@ -70,7 +288,7 @@ def read_nb(nb_src, ext=True):
                 os.path.join(get_base_dir(), "atoms", nb_src),
                 'r',
                 encoding='utf8') as f:
-            nb = nbformat.read(f, nbformat.NO_CONVERT)
+            nb = reads_nb(f.read(), nb_src)
 
     else:
         print("Couldn't find or process notebook file at: " + nb_src)
@@ -123,6 +341,8 @@ def remove_outputs(nb):
 
 
 def clear_notebook(old_ipynb, new_ipynb):
+    import nbformat
+
     with io.open(old_ipynb, 'r') as f:
         nb = nbformat.read(f, nbformat.NO_CONVERT)
 
@@ -149,22 +369,97 @@ This notebook may depend on the following libraries: $libs
 """
 
 
+HEADER_PATTERNS = (
+    re.compile('(?<!#)# '),
+    re.compile('(?<!#)## '),
+    re.compile('(?<!#)### '),
+    re.compile('(?<!#)#### '),
+)
+
+
+def header_levels(source):
+    """
+    Return the header levels (1-4) found in a markdown source, once
+    for every header, in order of level.
+
+    Parameters
+    ==========
+    source: String
+        Markdown cell source.
+
+    Returns
+    =======
+    levels: list of int
+    """
+    # Delete code blocks -- this is a bit brutal
+    # and it might be better to escape them in some
+    # way... but this at least works well enough
+    source = re.sub(r'```.+?```', '', source, flags=re.S)
+    levels = []
+    for j, rh in enumerate(HEADER_PATTERNS):
+        levels.extend([j + 1] * len(rh.findall(source)))
+    return levels
+
+
+def copy_cell(cell):
+    """
+    Return a new cell that can be modified without touching the
+    original. Metadata is copied deeply; outputs and attachments get a
+    new container but share their (potentially large) payloads, so
+    code replacing an output must swap the entry, not edit it in place.
+    """
+    from nbformat import NotebookNode
+
+    new = NotebookNode(cell)
+    new['metadata'] = copy.deepcopy(cell.get('metadata', {}))
+    if 'outputs' in cell:
+        new['outputs'] = list(cell['outputs'])
+    if 'attachments' in cell:
+        new['attachments'] = dict(cell['attachments'])
+    return new
+
+
 class Cell(object):
-    """docstring for Cell"""
+    """
+    A parsed cell of a notebook. Cells never modify the underlying
+    Jupyter cell: content is handed out as new cell objects so that a
+    parsed notebook can be shared between compiles.
+
+    Parameters
+    ==========
+    nb: nbformat.notebooknode.NotebookNode
+        The notebook containing the cell.
+    idx: int
+        Index of the cell within nb.
+    source: String
+        Optional replacement source (e.g. the title cell with its
+        metadata list removed). Defaults to the cell's own source.
+    metadata: dict
+        Optional geopyter metadata to attach to the cell's content.
+    """
+
+    # Whole atom libraries are loaded for catalog and lint jobs, so cells
+    # are kept small: no per-instance __dict__, and the include-only
+    # attributes (included_nb, sections, notebook) stay unset otherwise.
+    __slots__ = ('nb', 'idx', '_source', '_metadata', 'cell_type',
+                 'included_nb', 'sections', 'notebook')
 
-    def __init__(self, nb, idx):
+    def __init__(self, nb, idx, source=None, metadata=None):
         #super(Cell, self).__init__()
         self.nb = nb
         self.idx = idx
+        self._source = source
+        self._metadata = metadata
 
-        if "@include" in self.nb.cells[self.idx].source:
+        if "@include" in self.source():
             self.cell_type = 'include'
             self.included_nb, self.sections = self.parse_include(
-                self.nb.cells[self.idx].source)
+                self.source())
         else:
-            self.cell_type = self.nb.cells[idx].cell_type
+            self.cell_type = self.nb['cells'][idx]['cell_type']
 
-    def parse_include(self, include):
+    @staticmethod
+    def parse_include(include):
         """Parse section-subsection include syntax
 
         Parameters
@@ -184,18 +479,17 @@ class Cell(object):
         =======
         """
         include = include.split("\n")[1:-1]
-        nb = include[0].split("=")[1]
+        nb = include[0].split("=", 1)[1]
         sections = None
         try:
             sections = include[1].split("=")[1]
             sections = sections.split(";")
 
-            nb = nb.strip()
-            sections = map(str.strip, sections)
+            sections = tuple(map(str.strip, sections))
         except IndexError:
             pass
 
-        return nb, sections
+        return nb.strip(), sections
 
     def is_include(self):
         """Determine if this is an include cell"""
@@ -205,47 +499,24 @@ class Cell(object):
             return False
 
     def source(self):
-        return self.nb.cells[self.idx].source
-
-    def set_metadata(self, val, nm=None, namespace='geopyter'):
-
-        if namespace is None:
-            self.nb.cells[self.idx].metadata[nm] = val
-
-        else:
-            # Check for the namespace in the notebook metadata
-            if namespace not in self.nb.cells[self.idx].metadata:
-                self.nb.cells[self.idx].metadata[namespace] = {}
-
-            if nm is None:
-                self.nb.cells[self.idx].metadata[namespace] = val
-            else:
-                self.nb.cells[self.idx].metadata[namespace][nm] = val
+        if self._source is not None:
+            return self._source
+        # Item rather than attribute access: NotebookNode.__getattr__ is
+        # comparatively slow and this is called for every cell, often
+        return self.nb['cells'][self.idx]['source']
 
     def get_content(self):
         """Return the compiled cells from the jupyter notebook"""
         if self.is_include():
-            new_cells = []
-            if self.sections is None:
-                print("Importing all of " + self.notebook.name)
-                ids = self.notebook.get_section(None)
-                for i in ids:
-                    new_cells.extend(
-                        self.notebook.get_cell_by_id(i).get_content())
-            else:
-                for section in self.sections:
-                    print("Getting section from " +
-                          str(self.notebook.nb_path) + ": " + section)
-                    ids = self.notebook.get_section(section)
-                    #print(ids)
-                    for i in ids:
-                        new_cells.extend(
-                            self.notebook.get_cell_by_id(i).get_content())
-
-            #print("Returning " + str(len(new_cells))) + " new cells"
-            return new_cells
+            # Expansion is memoized on the included notebook, so an atom
+            # reached along several include paths is only expanded once
+            return self.notebook.get_content(self.sections)
         else:  # In case there is something odd about the cell -- always return a list
-            return [self.nb.cells[self.idx]]
+            cell = copy_cell(self.nb.cells[self.idx])
+            cell['source'] = self.source()
+            if self._metadata is not None:
+                cell.metadata['geopyter'] = copy.deepcopy(self._metadata)
+            return [cell]
 
     def get_jp_cell(self):
         """Return the cell from the jupyter notebook"""
@@ -271,48 +542,140 @@ class Cell(object):
             return self.nb.metadata[namespace][nm]
 
 
+class CellList(object):
+    """
+    The Cells of a NoteBook as a read-only sequence.
+
+    Only include cells, which hold parse results and a child notebook,
+    are kept; every other Cell is a cheap view built when it is asked
+    for. Together with the offset arrays in NoteBook.structure this keeps
+    a loaded atom library close to the size of the notebooks themselves.
+    """
+
+    __slots__ = ('notebook', 'includes')
+
+    def __init__(self, notebook):
+        self.notebook = notebook
+        self.includes = {}  # Cell index -> include Cell
+
+    def __len__(self):
+        return len(self.notebook.nb['cells'])
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if idx in self.includes:
+            return self.includes[idx]
+        if not 0 <= idx < len(self):
+            raise IndexError("cell index out of range")
+        nb = self.notebook
+        return Cell(nb.nb,
+                    idx,
+                    source=nb.title_source if idx == 0 else None,
+                    metadata=nb.cell_metadata)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
 class NoteBook(object):
-    def __init__(self, ipynb):
+    def __init__(self, ipynb, registry=None, sources=None, _stack=()):
+        """
+        Parse a notebook and, recursively, every notebook it includes.
+
+        Includes are resolved as a DAG: each distinct notebook is
+        loaded once per registry, however many include paths lead to
+        it, and a cyclic include raises IncludeCycleError.
+
+        Parameters
+        ==========
+        ipynb: String
+            Path or URL of the notebook (see read_nb).
+        registry: dict
+            Optional mapping of resolved notebook location to NoteBook.
+            Pass the same dict to several NoteBooks to share parsed atoms
+            between them. Defaults to a new, private registry.
+        sources: dict
+            Optional mapping of resolved notebook location to an
+            already-read notebook object, used instead of calling read_nb
+            (see geopyter.aio, which reads them concurrently).
+        """
 
         ipynb = ipynb.strip()
 
         self.base_dir = get_base_dir()
 
+        if registry is None:
+            registry = {}
+        self.registry = registry
+        self.key = resolve_nb_src(ipynb) or ipynb
+
         print("Instantiating: " + ipynb)  # + " (" + str(self) + ")")
-        self.nb = read_nb(ipynb)
+        if sources is not None and self.key in sources:
+            self.nb = sources[self.key]
+        else:
+            self.nb = read_nb(ipynb)
+
+        # Hash of the notebook as read, before any metadata is attached
+        self.source_hash = hashlib.sha256(
+            json.dumps(self.nb, sort_keys=True).encode('utf8')).hexdigest()
 
         self.nb_path = self.nb.metadata[
             'path']  # Path needs to come from the notebook object
-        self.cells = []
+        self.cells = CellList(self)
         self.included_nbs = {}
+        self._content = {}  # Memoized expansions, keyed by selection
+        self._revision = 0  # Bumped by set_metadata
+        self._aggregate = None  # (subtree_key, aggregate_metadata())
+        self._content_hash = None  # See content_hash
+
+        stack = _stack + (self.key, )
 
-        self.structure = defaultdict(list)
-        for i, c in enumerate(self.nb.cells):
-            cell = Cell(self.nb, i)
-            cell.set_metadata(self.get_user_metadata(
-            ))  # Note: pass by ref (all cells get same metadata)
-            cell.set_metadata(
-                nm='git', val=self.get_git_metadata()
-            )  # Note: pass by ref (all cells get same metadata)
+        # Metadata attached to the content of every cell (each cell
+        # gets its own copy when its content is requested)
+        self.cell_metadata = dict(self.get_user_metadata())
+        self.cell_metadata['git'] = self.get_git_metadata()
+        # Resolves relative assets; see portable_path
+        self.cell_metadata['source'] = portable_path(self.key)
+
+        # Cell offsets by type, as compact unsigned int arrays
+        self.structure = defaultdict(partial(array, 'I'))
+        for i in range(len(self.nb.cells)):
+            cell = self.cells[i]
 
             if cell.is_include():  # If the type is include...
 
-                # Create a new notebook from the URL
-                # and stash a reference on the cell
+                # Create a new notebook from the URL (or reuse the one
+                # already in the registry) and stash a reference on the cell
                 if cell.included_nb not in self.included_nbs:
-                    my_nb = NoteBook(cell.included_nb)
-                    self.included_nbs[cell.included_nb] = my_nb
+                    key = resolve_nb_src(
+                        cell.included_nb) or cell.included_nb.strip()
+                    if key in stack:
+                        raise IncludeCycleError(
+                            stack[stack.index(key):] + (key, ))
+                    if key not in registry:
+                        registry[key] = NoteBook(cell.included_nb,
+                                                 registry=registry,
+                                                 sources=sources,
+                                                 _stack=stack)
+                    self.included_nbs[cell.included_nb] = registry[key]
 
                 cell.notebook = self.included_nbs[cell.included_nb]
+                self.cells.includes[i] = cell
 
-            self.cells.append(cell)
             self.structure[cell.cell_type].append(i)
 
-        self.set_metadata(self.get_user_metadata().copy(
-        ))  # Note: pass by copy (notebook can have different metadata)
+        self.set_metadata(
+            copy.deepcopy(self.cell_metadata)
+        )  # Note: pass by copy (notebook can have different metadata)
         self.set_metadata(nm='libs', val=self.get_libs().copy())
 
-    def write(self, fn=None, nb=None):
+        registry.setdefault(self.key, self)
+
+    def write(self, fn=None, nb=None, assets_dir=None, strict=False):
         """
         Write a notebook to the path specified.
 
@@ -324,6 +687,17 @@ class NoteBook(object):
             '.ipynb' to the filename; however we recommend that
             you not get lazy and rely on this feature since it may
             go away in the future.
+        nb: nbformat.notebooknode.NotebookNode
+            The notebook to write. Defaults to the compiled notebook.
+        assets_dir: String
+            If given, images and data files that cells reference by
+            relative path are collected into this shared directory and
+            the references rewritten to match (see geopyter.assets).
+        strict: boolean
+            Raise ValidationError, rather than only report it, if the
+            notebook is invalid against the nbformat schema. Either way
+            a notebook is validated once per content (see
+            geopyter.validate).
 
         Returns
         =======
@@ -332,35 +706,158 @@ class NoteBook(object):
 
         # Simple default behaviour
         if fn is None:
-            fn = re.sub('(?:\.ipynb)?$', '-compiled.ipynb', self.nb_path)
+            fn = re.sub('(?:\.ipynb)?$',
+                        '-compiled.ipynb',
+                        self.nb_path,
+                        count=1)
 
         # Append file extension
         if not fn.endswith('.ipynb'):
             fn += '.ipynb'
 
-        # Append the credits cell
-        self.nb.cells.append(
-            nbformat.v4.new_markdown_cell(source=self.get_credits()))
-
         # Create any missing dirs
         try:
             os.makedirs(os.path.dirname(fn))
         except OSError:
             pass
 
-        # Write the compiled notebook
+        # Write the compiled notebook (which already ends with credits)
         if nb is None:
+            if not hasattr(self, 'compiled'):
+                self.compile()
             nb = self.compiled
 
+        if assets_dir is not None:
+            from .assets import bundle_assets
+            nb = bundle_assets(nb, fn, assets_dir)
+
         # Write raw notebook content
+        from .validate import writes_nb
         with io.open(fn, 'w', encoding='utf8') as f:
-            nbformat.write(nb, f, nbformat.NO_CONVERT)
+            f.write(writes_nb(nb, strict=strict, nb_src=fn))
+            f.write('\n')
+
+    def export(self,
+               formats=('html', 'slides', 'markdown', 'latex'),
+               out_dir=None,
+               stem=None,
+               max_workers=None):
+        """
+        Render the compiled notebook to other formats in parallel,
+        without writing and re-reading the .ipynb first. Compiles the
+        notebook if that has not been done yet.
+
+        Parameters
+        ==========
+        formats: iterable of String
+            Any of 'html', 'slides', 'markdown' and 'latex'.
+        out_dir: String
+            Output directory. Defaults to the notebook's own directory.
+        stem: String
+            Output file name without suffix. Defaults to the notebook's
+            name with '-compiled' appended (as for write).
+        max_workers: int
+            Size of the worker pool. Defaults to the number of CPUs.
+
+        Returns
+        =======
+        written: dict
+            Mapping of (stem, format) to output path for the formats that
+            changed and were rendered on this call.
+        """
+        from .export import export_notebooks
+
+        if not hasattr(self, 'compiled'):
+            self.compile()
+
+        if stem is None:
+            stem = re.sub('(?:\.ipynb)?$',
+                          '-compiled',
+                          os.path.basename(self.nb_path),
+                          count=1)
+        if out_dir is None:
+            out_dir = os.path.dirname(self.nb_path) or '.'
+
+        return export_notebooks({stem: self.compiled},
+                                formats=formats,
+                                out_dir=out_dir,
+                                max_workers=max_workers)
+
+    def execute(self, kernel_name='python3', timeout=600, cache_dir=None):
+        """
+        Execute the compiled notebook, replacing whatever stale outputs
+        the atoms carried. Outputs are cached per code cell (see
+        geopyter.execute), so an unchanged notebook does not start a
+        kernel; after a change, the cells before it are still run again
+        to rebuild kernel state. Compiles the notebook if that has not
+        been done yet.
+
+        Parameters
+        ==========
+        kernel_name: String
+            Jupyter kernel to execute with. Defaults to 'python3'.
+        timeout: int
+            Per-cell timeout in seconds.
+        cache_dir: String
+            Directory for cached outputs. Defaults to ~/.cache/geopyter.
+
+        Returns
+        =======
+        Void. This replaces the `compiled` attribute.
+        """
+        from .execute import OutputCache, execute_notebook
+
+        if not hasattr(self, 'compiled'):
+            self.compile()
+
+        self.compiled = execute_notebook(
+            self.compiled,
+            cache=OutputCache(cache_dir),
+            kernel_name=kernel_name,
+            timeout=timeout,
+            cwd=os.path.dirname(os.path.abspath(self.nb_path)))
+
+    def optimize_images(self,
+                        max_size=1024,
+                        quality=85,
+                        max_workers=None,
+                        cache_dir=None):
+        """
+        Downsample and recompress the images embedded in the compiled
+        notebook (outputs and attachments) on a process pool, caching
+        the result for each distinct image (see geopyter.images).
+        Compiles the notebook if that has not been done yet.
+
+        Parameters
+        ==========
+        max_size: int
+            Maximum width and height in pixels. Defaults to 1024.
+        quality: int
+            JPEG quality. Defaults to 85.
+        max_workers: int
+            Size of the process pool. Defaults to the number of CPUs.
+        cache_dir: String
+            Cache root. Defaults to ~/.cache/geopyter.
+
+        Returns
+        =======
+        Void. This replaces the `compiled` attribute.
+        """
+        from .images import optimize_images
+
+        if not hasattr(self, 'compiled'):
+            self.compile()
+
+        self.compiled = optimize_images(self.compiled,
+                                        max_size=max_size,
+                                        quality=quality,
+                                        max_workers=max_workers,
+                                        cache_dir=cache_dir)
 
     def get_credits(self):
         from string import Template
         msg = credit_template
-        metadata = self.compose_metadata()
-        metadata = metadata['geopyter']
+        metadata = self.aggregate_metadata()
         contributors = metadata['Contributors']
         contributors = ",\n".join(contributors)
         libs = metadata['libs']
@@ -475,6 +972,85 @@ class NoteBook(object):
 
         return parent_range
 
+    def get_content(self, sections=None):
+        """
+        Return the fully expanded cells for a selection of this notebook.
+
+        Results are memoized per selection, so a notebook included from
+        several places is only expanded once for each distinct selection.
+
+        Parameters
+        ==========
+        sections: iterable of String
+            Section-subsection selections (see get_section), or None for
+            the entire notebook.
+
+        Returns
+        =======
+        list: Jupyter-style cells
+        """
+        key = None if sections is None else tuple(sections)
+
+        if key not in self._content:
+            new_cells = []
+            spans = []
+            if key is None:
+                print("Importing all of " + str(self.nb_path))
+                self.expand(self.get_section(None), new_cells, spans)
+            else:
+                for section in key:
+                    print("Getting section from " + str(self.nb_path) +
+                          ": " + section)
+                    self.expand(self.get_section(section), new_cells, spans)
+            self._content[key] = (new_cells, spans)
+
+        return list(self._content[key][0])
+
+    def get_spans(self, sections=None):
+        """
+        Return where the includes of a selection landed in its expansion
+        (see get_content), as a list of (offset, length, NoteBook,
+        sections) tuples.
+        """
+        self.get_content(sections)
+        return self._content[None if sections is None else tuple(sections)][1]
+
+    def expand(self, ids, new_cells, spans):
+        """
+        Append the expanded content of the given cells to new_cells, and
+        a (offset, length, NoteBook, sections) tuple to spans for each
+        include among them.
+        """
+        for i in ids:
+            cell = self.get_cell_by_id(i)
+            content = cell.get_content()
+            if cell.is_include():
+                spans.append((len(new_cells), len(content), cell.notebook,
+                              cell.sections))
+            new_cells.extend(content)
+
+    @property
+    def content_hash(self):
+        """
+        Hash of everything this notebook contributes to compiled cells
+        by itself: its source and the metadata attached to its cells.
+        Unlike subtree_key, it does not depend on what it includes.
+
+        The git metadata is left out: for a local notebook it describes
+        the HEAD of the whole checkout, so every commit would change the
+        hash of every notebook. patch brings it up to date in the cells
+        it keeps instead.
+        """
+        if self._content_hash is None:
+            metadata = dict((k, v) for k, v in self.cell_metadata.items()
+                            if k != 'git')
+            h = hashlib.sha1(self.source_hash.encode('utf8'))
+            h.update(
+                json.dumps(metadata, sort_keys=True,
+                           default=str).encode('utf8'))
+            self._content_hash = h.hexdigest()
+        return self._content_hash
+
     def get_selection(self, sections):
         new_cells = []
         for s in sections:
@@ -515,27 +1091,14 @@ class NoteBook(object):
         return self.cells[id].get_jp_cell()
 
     def get_header_cells(self):
-        rh1 = re.compile('(?<!#)# ')
-        rh2 = re.compile('(?<!#)## ')
-        rh3 = re.compile('(?<!#)### ')
-        rh4 = re.compile('(?<!#)#### ')
-        rhs = rh1, rh2, rh3, rh4
         hs = {1: [], 2: [], 3: [], 4: []}
         idxs = self.structure['markdown']
         cells = self.get_cells_by_id(idxs)
         pairs = zip(idxs, cells)
         for idx, cell in pairs:
             #source = cell['source']
-            source = cell.source()
-            # Delete code blocks -- this is a bit brutal
-            # and it might be better to escape them in some
-            # way... but this at least works well enough
-            source = re.sub(r'```.+?```', '', source, flags=re.S)
-            for j, rh in enumerate(rhs):
-                fa = rh.findall(source)
-                if fa:
-                    for match in fa:
-                        hs[j + 1].append(idx)
+            for level in header_levels(cell.source()):
+                hs[level].append(idx)
         return hs
 
     def get_tree(self):
@@ -618,6 +1181,9 @@ class NoteBook(object):
         =======
         Void.
         """
+        # Invalidate memoized aggregates for this subtree (see subtree_key)
+        self._revision = getattr(self, '_revision', 0) + 1
+
         if namespace is None:
             self.nb.metadata[nm] = val
 
@@ -651,11 +1217,16 @@ class NoteBook(object):
         # Initialise the user_metadata attribute if it doesn't exist
         if not hasattr(self, 'user_metadata'):
 
-            # Retrieve the source from the first cell
-            src = self.nb.cells[0]['source']
-
             meta = {}
 
+            # The source of the first cell with the metadata list removed,
+            # used in place of the original when composing (the notebook
+            # itself is left untouched). None if nothing was parsed.
+            self.title_source = None
+
+            # Retrieve the source from the first cell
+            src = self.nb.cells[0]['source'] if self.nb.cells else ""
+
             content = ""
 
             # Try to parse it -- warn the user (but don't die) if
@@ -682,8 +1253,8 @@ class NoteBook(object):
                         content += l + "\n"
                     else:
                         content += l + "\n"
-                self.user_metadata = meta
-                self.nb.cells[0]['source'] = content
+                self.title_source = content
+            self.user_metadata = meta
 
         return self.user_metadata
 
@@ -704,6 +1275,12 @@ class NoteBook(object):
         rp: dict
             A dictionary containing relevant git metadata
         """
+        if not hasattr(self, 'repo') and self.nb_path.startswith('git+'):
+            # Pinned sources carry the metadata of the commit they were
+            # read from rather than of the local checkout
+            from .mirror import git_metadata
+            self.repo = git_metadata(self.nb_path)
+
         if not hasattr(self, 'repo'):
 
             if repo_path is None:
@@ -716,6 +1293,7 @@ class NoteBook(object):
 
             # Throws InvalidGitRepositoryError if a .git directory
             # could be found in the recursion process above.
+            from git import Repo
             repo = Repo(repo_path)
 
             rp = {}
@@ -853,7 +1431,7 @@ class NoteBook(object):
                 if larger:
                     end = min(larger) - 1
                 else:
-                    end = n_cells
+                    end = n_cells - 1
                 # now check if there is a closer sup in the parent level
                 p = k - 1
                 while p > 0:
@@ -869,41 +1447,94 @@ class NoteBook(object):
         mapping.sort()
         return dict([(key, [key, s, e]) for key, s, e in mapping])
 
-    def compose_metadata(self):
-        """Return combined metadata from the source notebooks."""
+    def subtree_key(self, _memo=None):
+        """
+        Return a hash identifying the current state of this notebook and
+        everything it includes: the source hashes plus a revision that
+        set_metadata bumps. It changes exactly when something in the
+        subtree changes.
+        """
+        if _memo is None:
+            _memo = {}
+        if self.key not in _memo:
+            h = hashlib.sha1(self.source_hash.encode('utf8'))
+            h.update(str(self._revision).encode('utf8'))
+            for n in self.included_nbs.values():
+                h.update(n.subtree_key(_memo).encode('utf8'))
+            _memo[self.key] = h.hexdigest()
+        return _memo[self.key]
+
+    def aggregate_metadata(self, _memo=None):
+        """
+        Return the contributors, libraries and git sources of this
+        notebook and, transitively, of everything it includes.
 
-        for n in self.included_nbs.values():
-            try:
-                c1 = n.get_metadata("Contributors")
-                if isinstance(c1, str):
-                    c1 = [c1]
+        Aggregates are built bottom-up through the include DAG and
+        memoized on each notebook, keyed by its subtree_key, so they are
+        only rebuilt for subtrees that changed.
 
-                try:
-                    c2 = self.get_metadata("Contributors")
-                    if isinstance(c2, str):
-                        c2 = [c2]
-                except KeyError:
-                    c2 = []
-                c1.extend(c2)
-                contribs = list(set(c1))
-                self.set_metadata(nm="Contributors", val=contribs)
+        Returns
+        =======
+        aggregate: dict
+            'Contributors': sorted list of names;
+            'libs': dict of library to version, where a notebook's own
+                versions take precedence over those of its includes;
+            'sources': dict of notebook path to the git commit SHA it was
+                read at.
+            Treat it as read-only: it is shared with later calls.
+        """
+
+        def as_list(val):
+            if val is None:
+                return []
+            if isinstance(val, str):
+                return [val]
+            return list(val)
 
-            except KeyError:
-                print("No contributors found for: " + n.name)
-                pass
+        if _memo is None:
+            _memo = {}
+        key = self.subtree_key(_memo)
+        if self._aggregate is not None and self._aggregate[0] == key:
+            return self._aggregate[1]
 
-            try:
-                c1 = n.get_libs()
-                c2 = self.get_libs()
+        geopyter = self.nb.metadata.get('geopyter', {})
+        contribs = set(as_list(geopyter.get("Contributors")))
+        libs = {}
+        sources = {}
+
+        for n in self.included_nbs.values():
+            child = n.aggregate_metadata(_memo)
+            if not child['Contributors']:
+                print("No contributors found for: " + str(n.nb_path))
+            contribs.update(child['Contributors'])
+            libs.update(child['libs'])
+            sources.update(child['sources'])
+
+        # This notebook's own versions take precedence
+        libs.update(geopyter.get('libs', {}))
+        if 'git' in geopyter:
+            sources[self.nb_path] = geopyter['git'].get('sha')
+
+        aggregate = {
+            'Contributors': sorted(contribs),
+            'libs': libs,
+            'sources': sources,
+        }
+        self._aggregate = (key, aggregate)
+        return aggregate
 
-                c1.update(c2)
-                self.set_metadata(nm="libs", val=c1)
+    def compose_metadata(self):
+        """
+        Return combined metadata from the source notebooks.
 
-            except KeyError:
-                print("No libraries found for: " + n.name)
-                pass
+        This builds a new metadata dict: neither this notebook's metadata
+        nor that of the included notebooks is modified.
+        """
+        metadata = copy.deepcopy(self.nb['metadata'])
+        geopyter = metadata.setdefault('geopyter', {})
+        geopyter.update(copy.deepcopy(self.aggregate_metadata()))
 
-        return self.nb['metadata']
+        return metadata
 
     def compose_version(self):
         """Return highest notebook version from the source notebooks."""
@@ -928,39 +1559,635 @@ class NoteBook(object):
 
         return (highest_major_v, highest_minor_v)
 
-    def compose_content(self):
+    def compose_content(self, spans=None):
         """Compose a notebook from a composition notebook
 
+        Parameters
+        ==========
+        spans: list
+            If given, a (offset, length, NoteBook, sections) tuple is
+            appended for each include (see get_spans).
+
         Returns
         =======
         list: Jupyter-style cells for the composed notebook
         """
         new_cells = []
+        if spans is None:
+            spans = []
 
-        for idx, cell in enumerate(self.cells):  # For each geopyter cell
-            new_cells.extend(cell.get_content())
+        self.expand(range(len(self.cells)), new_cells, spans)
 
         print("Composing content for " + self.nb_path + " with " +
               str(len(new_cells)) + " cells of new content.")
         return new_cells
 
+    @classmethod
+    async def aload(cls, ipynb, registry=None, executor=None):
+        """Asynchronous NoteBook(ipynb); see geopyter.aio.aload"""
+        from .aio import aload
+        return await aload(ipynb, registry=registry, executor=executor)
+
+    async def acompile(self, executor=None):
+        """Asynchronous compile(); see geopyter.aio.acompile"""
+        from .aio import acompile
+        return await acompile(self, executor=executor)
+
     def compile(self):
         """Compile notebook
 
+        No parameters are passed. This sets (and returns) the `compiled`
+        attribute, a new notebook whose cells and metadata are independent
+        of the parsed source notebooks."""
 
-        No parameters are passed. This sets the `compiled` attribute."""
+        self.compiled = self.compile_variants([Variant('compiled')
+                                               ])['compiled']
+        return self.compiled
 
-        nb = nbformat.v4.new_notebook()  # Create a new notebook
+    def compile_variants(self, variants=None):
+        """
+        Compile several variants of the notebook (e.g. student,
+        instructor and slides) from a single parse and compose pass.
 
-        nb.metadata = self.compose_metadata()  # Set the metadata details
+        Parameters
+        ==========
+        variants: list of Variant
+            The variants to produce. Defaults to VARIANTS.
+
+        Returns
+        =======
+        compiled: dict
+            Mapping of variant name to compiled notebook. Each notebook
+            has its own copies of the cells it keeps.
+        """
+        import nbformat
+
+        if variants is None:
+            variants = VARIANTS
+
+        metadata = self.compose_metadata()  # Set the metadata details
+        version = self.compose_version()  # Set the version info
+        spans = []
+        content = self.compose_content(spans)  # Compose the notebook content
+        credits = self.get_credits_cell()
+
+        compiled = {}
+        for variant in variants:
+            nb = nbformat.v4.new_notebook()  # Create a new notebook
+            nb.metadata = copy.deepcopy(metadata)
+            nb.nbformat, nb.nbformat_minor = version
+
+            # Expansions are memoized and shared so each compiled cell
+            # gets its own (shallow) copy
+            keep = [variant.keep(c) for c in content]
+            nb.cells = [copy_cell(c) for c, k in zip(content, keep) if k]
+            nb.cells.append(copy_cell(credits))  # Append the credits cell
+
+            geopyter = nb.metadata.setdefault('geopyter', {})
+            geopyter['variant'] = variant.name
+            geopyter['provenance'] = provenance(self, None, spans,
+                                                kept_offsets(keep))
 
-        nb.nbformat, nb.nbformat_minor = self.compose_version(
-        )  # Set the version info
+            unique_cell_ids(nb.cells, nb.nbformat_minor)
+            compiled[variant.name] = nb
+
+        return compiled
+
+    def get_credits_cell(self):
+        """
+        Return the credits as a markdown cell, with an id derived from
+        its content so that compiling unchanged sources gives an
+        identical notebook.
+        """
+        import nbformat
+
+        credits = self.get_credits()
+        return nbformat.v4.new_markdown_cell(
+            source=credits,
+            id=hashlib.sha1(credits.encode('utf8')).hexdigest()[:8])
+
+    def patch(self, compiled):
+        """
+        Bring a notebook compiled earlier from this session up to date
+        by re-expanding only the includes whose notebooks changed.
+
+        The provenance map that compile_variants stores in the geopyter
+        metadata records, for every include at every depth, the range of
+        compiled cells it produced along with the source notebook, the
+        selection and the notebook's content_hash. Ranges whose notebook
+        is unchanged are kept (descending into their own includes);
+        those whose notebook changed are expanded again and spliced in.
+        The git metadata of kept cells is refreshed (see content_hash),
+        and the credits cell and metadata are recomputed, from memoized
+        aggregates, so the result is the notebook a full compile would
+        give. If the session notebook itself changed, or there is no
+        provenance, the variant is compiled from scratch.
+
+        Parameters
+        ==========
+        compiled: nbformat.notebooknode.NotebookNode
+            A compiled notebook (or variant), e.g. read back from disk.
+            It is not modified.
+
+        Returns
+        =======
+        nb: nbformat.notebooknode.NotebookNode
+            The updated notebook.
+        """
+        geopyter = compiled.metadata.get('geopyter', {})
+        name = geopyter.get('variant', 'compiled')
+        variant = dict((v.name, v) for v in VARIANTS).get(name, Variant(name))
+        root = geopyter.get('provenance')
+
+        if not root or root['source'] != portable_path(self.key) or \
+                root['hash'] != self.content_hash:
+            print("Recompiling " + self.nb_path)
+            return self.compile_variants([variant])[name]
+
+        old_cells = compiled.cells
+        cells = []
+        stats = {'kept': 0, 'expanded': 0}
+
+        def keep_cells(nb, start, stop):
+            """Keep old cells that nb itself produced"""
+            git = nb.cell_metadata.get('git')
+            for c in old_cells[start:stop]:
+                c = type(c)(c)
+                meta = c.get('metadata', {}).get('geopyter')
+                if meta is not None and meta.get('git') != git:
+                    c['metadata'] = copy.deepcopy(c['metadata'])
+                    c['metadata']['geopyter']['git'] = copy.deepcopy(git)
+                cells.append(c)
+            stats['kept'] += stop - start
+
+        def splice(node):
+            nb = self.registry.get(local_path(node['source']))
+            if nb is None or nb.content_hash != node['hash']:
+                if nb is None:
+                    raise KeyError("Included notebook not loaded: " +
+                                   node['source'])
+                content = nb.get_content(node['select'])
+                keep = [variant.keep(c) for c in content]
+                new = provenance(nb, node['select'], nb.get_spans(
+                    node['select']), kept_offsets(keep), len(cells))
+                cells.extend(
+                    copy_cell(c) for c, k in zip(content, keep) if k)
+                stats['expanded'] += new['stop'] - new['start']
+                return new
+
+            start = len(cells)
+            includes = []
+            pos = node['start']
+            for child in node['includes']:
+                keep_cells(nb, pos, child['start'])
+                includes.append(splice(child))
+                pos = child['stop']
+            keep_cells(nb, pos, node['stop'])
+            return dict(node, start=start, stop=len(cells), includes=includes)
+
+        root = splice(root)
+        cells.append(self.get_credits_cell())
+
+        nb = type(compiled)(compiled)
+        nb.nbformat, nb.nbformat_minor = self.compose_version()
+        unique_cell_ids(cells, nb.nbformat_minor)
+        nb.metadata = self.compose_metadata()
+        nb.metadata['geopyter']['variant'] = name
+        nb.metadata['geopyter']['provenance'] = root
+        nb.cells = cells
+        print("Patched " + self.nb_path + ": kept " + str(stats['kept']) +
+              " cells, expanded " + str(stats['expanded']))
+        return nb
+
+    def compile_incremental(self, variants=None, cache=None):
+        """
+        Compile variants of the notebook as compile_variants does, but
+        patch the notebooks compiled by the previous call instead where
+        there are any (see patch), and keep the results for the next.
+        A one-line edit to an atom then re-expands only that atom.
+
+        Parameters
+        ==========
+        variants: list of Variant
+            The variants to produce. Defaults to VARIANTS.
+        cache: CompiledCache
+            Where the previous notebooks are kept. Defaults to the user
+            cache.
+
+        Returns
+        =======
+        compiled: dict
+            Mapping of variant name to compiled notebook.
+        """
+        if variants is None:
+            variants = VARIANTS
+        if cache is None:
+            cache = CompiledCache()
+
+        compiled = {}
+        missing = []
+        for variant in variants:
+            previous = cache.get(cache.key(self, variant.name))
+            if previous is None:
+                missing.append(variant)
+            else:
+                compiled[variant.name] = self.patch(previous)
+        if missing:
+            compiled.update(self.compile_variants(missing))
+
+        for variant in variants:
+            cache.put(cache.key(self, variant.name), compiled[variant.name])
+        return dict((v.name, compiled[v.name]) for v in variants)
+
+    def write_variants(self, variants=None, out_dir=None):
+        """
+        Compile and write several variants of the notebook. Each is
+        written next to the others as <name>-<variant>.ipynb.
+
+        Parameters
+        ==========
+        variants: list of Variant
+            The variants to produce. Defaults to VARIANTS.
+        out_dir: String
+            Output directory. Defaults to the notebook's own directory.
+
+        Returns
+        =======
+        paths: dict
+            Mapping of variant name to the path written.
+        """
+        if out_dir is None:
+            out_dir = os.path.dirname(self.nb_path)
+
+        stem = re.sub('(?:\.ipynb)?$',
+                      '',
+                      os.path.basename(self.nb_path),
+                      count=1)
+
+        paths = {}
+        for name, nb in self.compile_variants(variants).items():
+            paths[name] = os.path.join(out_dir, stem + '-' + name + '.ipynb')
+            self.write(paths[name], nb=nb)
+        return paths
+
+
+    def write_shards(self,
+                     out_dir=None,
+                     level=1,
+                     max_workers=None,
+                     nb=None,
+                     stem=None,
+                     assets_dir=None,
+                     strict=False):
+        """
+        Write the compiled notebook as one notebook per section plus a
+        small index notebook linking to them, so that students only open
+        the part they need.
+
+        The content is split before every markdown cell with a header
+        of the given level or higher (as found by header_levels, the
+        logic behind get_header_cells). Shards are serialised and written
+        on a thread pool, and files whose content is unchanged are left
+        alone. Shards left over from an earlier, longer split are removed.
+        Relative references that resolve from out_dir are rewritten for
+        the shard directory (see geopyter.assets.relocate_refs).
+
+        Parameters
+        ==========
+        out_dir: String
+            Output directory. Defaults to the notebook's own directory.
+        level: int
+            Split at headers of this level and above (1-4). Defaults to 1.
+        max_workers: int
+            Size of the thread pool. Defaults to Python's default.
+        nb: nbformat.notebooknode.NotebookNode
+            The notebook to split, e.g. a variant or an executed notebook.
+            Defaults to the compiled notebook.
+        stem: String
+            The index is written as <stem>.ipynb and the shards into a
+            <stem>/ subdirectory. Defaults, as for write(), to the
+            notebook's name with '-compiled' appended, so the source
+            notebook is never overwritten.
+        assets_dir: String
+            If given, images and data files that cells reference by
+            relative path are collected into this shared directory and
+            the references rewritten to match (see write()).
+        strict: boolean
+            Raise rather than report if a shard is invalid (see write()).
+
+        Returns
+        =======
+        paths: list of String
+            The index path followed by the shard paths.
+
+        Raises
+        ======
+        ValueError if any output path resolves to the source notebook.
+        """
+        import nbformat
+        from concurrent.futures import ThreadPoolExecutor
+
+        from .assets import bundle_assets, relocate_refs
+        from .validate import writes_nb
+
+        if nb is None:
+            if not hasattr(self, 'compiled'):
+                self.compile()
+            nb = self.compiled
+        if out_dir is None:
+            out_dir = os.path.dirname(self.nb_path)
+
+        name = re.sub('(?:\.ipynb)?$',
+                      '',
+                      os.path.basename(self.nb_path),
+                      count=1)
+        if stem is None:
+            stem = name + '-compiled'
+        index_fn = os.path.join(out_dir, stem + '.ipynb')
+        shard_dir = os.path.join(out_dir, stem)
+
+        if assets_dir is not None:
+            nb = bundle_assets(nb, index_fn, assets_dir)
+        # The last compiled cell holds the credits; they go in the index
+        content, credits = nb.cells[:-1], nb.cells[-1]
+
+        notebooks = []
+        links = []
+        for i, (title, cells) in enumerate(split_cells(content, level)):
+            slug = re.sub('[^A-Za-z0-9]+', '-', title).strip('-').lower()
+            fn = '{0:02d}-{1}.ipynb'.format(i + 1, slug[:40] or 'section')
+            shard = nbformat.v4.new_notebook()
+            shard.metadata = copy.deepcopy(nb.metadata)
+            shard.metadata.get('geopyter', {}).pop('provenance', None)
+            shard.nbformat = nb.nbformat
+            shard.nbformat_minor = nb.nbformat_minor
+            shard.cells = cells
+            notebooks.append((os.path.join(shard_dir, fn),
+                              relocate_refs(shard, out_dir, shard_dir)))
+            links.append("1. [" + title + "](" + stem + "/" + fn + ")")
+
+        index = nbformat.v4.new_notebook()
+        index.metadata = copy.deepcopy(nb.metadata)
+        index.metadata.get('geopyter', {}).pop('provenance', None)
+        index.nbformat = nb.nbformat
+        index.nbformat_minor = nb.nbformat_minor
+        index.cells = [
+            nbformat.v4.new_markdown_cell(
+                source="# " + getattr(self, 'name', name) + "\n\n" +
+                "\n".join(links),
+                id='index'),
+            copy_cell(credits)
+        ]
+        unique_cell_ids(index.cells, index.nbformat_minor)
+        notebooks.insert(0, (index_fn, index))
+
+        source = os.path.realpath(self.nb_path)
+        for fn, _ in notebooks:
+            if os.path.realpath(fn) == source:
+                raise ValueError("Refusing to overwrite the source notebook: " +
+                                 self.nb_path)
+
+        def write_if_changed(fn, nb):
+            data = writes_nb(nb, strict=strict, nb_src=fn)
+            if os.path.exists(fn):
+                with io.open(fn, 'r', encoding='utf8') as f:
+                    if f.read() == data:
+                        return fn
+            print("Writing shard: " + fn)
+            with atomic_write(fn, 'w') as f:
+                f.write(data)
+            return fn
+
+        os.makedirs(shard_dir, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            paths = list(
+                pool.map(lambda args: write_if_changed(*args), notebooks))
+
+        for fn in os.listdir(shard_dir):
+            if fn.endswith('.ipynb') and os.path.join(shard_dir,
+                                                      fn) not in paths:
+                os.remove(os.path.join(shard_dir, fn))
+
+        return paths
+
+
+def split_cells(cells, level=1):
+    """
+    Split a list of cells before every markdown cell containing a header
+    of the given level or higher.
+
+    Returns
+    =======
+    sections: list of (title, cells)
+        The title is the text of the first such header in the section
+        (or 'Introduction' for any content before the first one).
+    """
+    sections = []
+    for cell in cells:
+        levels = header_levels(
+            cell.source) if cell.cell_type == 'markdown' else []
+        if levels and min(levels) <= level or not sections:
+            title = 'Introduction'
+            for l in cell.source.splitlines():
+                m = re.match('#{1,' + str(level) + '} (.+)', l)
+                if m:
+                    title = m.group(1).strip()
+                    break
+            sections.append((title, []))
+        sections[-1][1].append(cell)
+    return sections
+
+
+class Variant(object):
+    """
+    Rules selecting which composed cells go into one output notebook.
+
+    Tags are read from the cell's `tags` metadata. Metadata rules map a
+    dotted path into the cell metadata (e.g. 'slideshow.slide_type') to a
+    value or list of values. A cell is kept if it has any of
+    include_tags (when given), matches every include rule, and has none
+    of exclude_tags and matches no exclude rule.
+
+    Parameters
+    ==========
+    name: String
+        Name of the variant, used as the output file suffix.
+    include_tags: list of String
+        Only keep cells carrying at least one of these tags.
+    exclude_tags: list of String
+        Drop cells carrying any of these tags.
+    include_metadata: dict
+        Only keep cells whose metadata matches all of these rules.
+    exclude_metadata: dict
+        Drop cells whose metadata matches any of these rules.
+    """
+
+    def __init__(self,
+                 name,
+                 include_tags=None,
+                 exclude_tags=None,
+                 include_metadata=None,
+                 exclude_metadata=None):
+        self.name = name
+        self.include_tags = set(include_tags or [])
+        self.exclude_tags = set(exclude_tags or [])
+        self.include_metadata = include_metadata or {}
+        self.exclude_metadata = exclude_metadata or {}
+
+    def __repr__(self):
+        return "Variant(" + repr(self.name) + ")"
+
+    @staticmethod
+    def match(cell, path, expected):
+        """Test the metadata value at a dotted path against a rule"""
+        val = cell.get('metadata', {})
+        for key in path.split('.'):
+            if not isinstance(val, dict) or key not in val:
+                return False
+            val = val[key]
+        if isinstance(expected, (list, tuple, set)):
+            return val in expected
+        return val == expected
+
+    def keep(self, cell):
+        """Return True if the cell belongs in this variant"""
+        tags = set(cell.get('metadata', {}).get('tags', []))
+
+        if self.include_tags and not tags & self.include_tags:
+            return False
+        if tags & self.exclude_tags:
+            return False
+        for path, expected in self.include_metadata.items():
+            if not self.match(cell, path, expected):
+                return False
+        for path, expected in self.exclude_metadata.items():
+            if self.match(cell, path, expected):
+                return False
+        return True
+
+
+# Default course variants: students get no solutions or instructor notes,
+# instructors get everything, slides drop cells marked as skipped/notes.
+VARIANTS = [
+    Variant('student', exclude_tags=['solution', 'instructor']),
+    Variant('instructor'),
+    Variant('slides',
+            exclude_tags=['no-slides'],
+            exclude_metadata={'slideshow.slide_type': ['skip', 'notes']}),
+]
+
+
+def kept_offsets(keep):
+    """
+    Map offsets in an expansion to offsets once cells are filtered:
+    given a list of booleans, return the number of kept cells before
+    each position (and, last, the total).
+    """
+    offsets = array('I', [0])
+    for k in keep:
+        offsets.append(offsets[-1] + bool(k))
+    return offsets
+
+
+def provenance(nb, sections, spans, offsets, base=0):
+    """
+    Describe where the expansion of a selection of a notebook, and of
+    every include within it, landed in a compiled notebook.
+
+    Parameters
+    ==========
+    nb: NoteBook
+        The notebook expanded.
+    sections: iterable of String
+        The selection (None for everything).
+    spans: list
+        Its includes, as returned by get_spans.
+    offsets: array
+        kept_offsets for the expansion, mapping it to compiled cells.
+    base: int
+        Index of the compiled cell the expansion starts at.
+
+    Returns
+    =======
+    node: dict
+        'source' (see portable_path), 'select' and 'hash' (the
+        notebook's content_hash), 'start' and 'stop' (the range of compiled cells) and 'includes',
+        a list of nodes of the same form.
+    """
+
+    def node(nb, sections, spans, offset, length):
+        return {
+            'source': portable_path(nb.key),
+            'select': None if sections is None else list(sections),
+            'hash': nb.content_hash,
+            'start': base + offsets[offset],
+            'stop': base + offsets[offset + length],
+            'includes': [
+                node(child, s, child.get_spans(s), offset + o, n)
+                for o, n, child, s in spans
+            ],
+        }
+
+    return node(nb, sections, spans, 0, len(offsets) - 1)
+
+
+def unique_cell_ids(cells, nbformat_minor=5):
+    """
+    Make the cell ids of a compiled notebook valid for its nbformat
+    version (modifying the cells). Before 4.5 cells have no ids, so any
+    are removed. From 4.5 every cell needs a unique id: cells from older
+    sources get one derived from their source, and repeated ids (e.g.
+    from an atom included twice) are replaced by new, deterministic ones.
+    """
+    if nbformat_minor < 5:
+        for cell in cells:
+            cell.pop('id', None)
+        return
+
+    seen = set()
+    for cell in cells:
+        cid = cell.get('id')
+        if cid is None:
+            cid = hashlib.sha1(cell.source.encode('utf8')).hexdigest()[:8]
+        base, n = cid, 0
+        while cid in seen:
+            n += 1
+            cid = hashlib.sha1(
+                (base + '-' + str(n)).encode('utf8')).hexdigest()[:8]
+        cell['id'] = cid
+        seen.add(cid)
+
+
+def compile_notebooks(ipynbs, registry=None, max_workers=None):
+    """
+    Compile several notebooks, sharing parsed atoms between them.
+
+    Notebooks are parsed one after another into a single registry, so
+    an atom used by several sessions is read once; composition, which
+    no longer modifies the parsed notebooks, then runs on a thread pool.
+
+    Parameters
+    ==========
+    ipynbs: list of String
+        Paths or URLs of the notebooks to compile.
+    registry: dict
+        Optional registry of already-parsed notebooks (see NoteBook).
+    max_workers: int
+        Size of the thread pool. Defaults to Python's default.
+
+    Returns
+    =======
+    compiled: dict
+        Mapping of each input path to its compiled notebook.
+    """
+    from concurrent.futures import ThreadPoolExecutor
 
-        nb.cells = self.compose_content()  # Compose the notebook content
+    if registry is None:
+        registry = {}
 
-        # Append the credits cell
-        nb.cells.append(
-            nbformat.v4.new_markdown_cell(source=self.get_credits()))
+    notebooks = [(ipynb, NoteBook(ipynb, registry=registry))
+                 for ipynb in ipynbs]
 
-        self.compiled = nb
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [(ipynb, pool.submit(n.compile)) for ipynb, n in notebooks]
+        return {ipynb: f.result() for ipynb, f in futures}
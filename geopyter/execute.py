@@ -0,0 +1,220 @@
+"""
+Execute compiled notebooks on a bounded pool of local kernels,
+caching the outputs of every code cell so that unchanged notebooks
+never start a kernel at all.
+
+A notebook with any changed code cell is not cheaper to execute than
+a fresh one, however: a kernel cannot be restored to the state it had
+part-way through a notebook, so every code cell before the first
+change is run again (its cached outputs are kept) before the changed
+cells are. Caching saves the kernel entirely for unchanged notebooks,
+not the prefix of changed ones.
+"""
+
+import copy
+import hashlib
+import json
+import os
+import platform
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from .core import DiskCache
+
+
+def environment_hash(nb, kernel_name='python3', extra=None):
+    """
+    Hash what, besides the code itself, determines a cell's outputs:
+    the kernel, the interpreter, the platform and the library versions
+    recorded in the notebook's geopyter metadata.
+
+    Parameters
+    ==========
+    nb: nbformat.notebooknode.NotebookNode
+        The notebook that is about to be executed.
+    kernel_name: String
+        Name of the Jupyter kernel that will run it.
+    extra: String
+        Anything else that should invalidate the cache when changed
+        (e.g. a data release tag).
+
+    Returns
+    =======
+    String: a hex digest.
+    """
+    libs = nb.metadata.get('geopyter', {}).get('libs', {})
+    env = {
+        'kernel': kernel_name,
+        'python': sys.version,
+        'platform': platform.platform(),
+        'libs': libs,
+        'extra': extra,
+    }
+    return hashlib.sha256(json.dumps(env, sort_keys=True,
+                                     default=str).encode('utf8')).hexdigest()
+
+
+def cell_keys(nb, env):
+    """
+    Compute a cache key for each code cell from the source of every code
+    cell up to and including it, plus the environment hash. A change to
+    one cell therefore changes its key and the key of every cell after it.
+
+    Returns
+    =======
+    keys: dict
+        Mapping of cell index to key, for code cells only.
+    """
+    h = hashlib.sha256(env.encode('utf8'))
+    keys = {}
+    for i, cell in enumerate(nb.cells):
+        if cell.cell_type == 'code':
+            h.update(cell.source.encode('utf8'))
+            h.update(b'\0')
+            keys[i] = h.hexdigest()
+    return keys
+
+
+class OutputCache(DiskCache):
+    """Cell outputs stored on disk as one small JSON file per key"""
+
+    name = 'outputs'
+    suffix = '.json'
+
+    def get(self, key):
+        import nbformat
+
+        return nbformat.from_dict(json.loads(self.read(key).decode('utf8')))
+
+    def put(self, key, cell):
+        self.write(
+            key,
+            json.dumps({
+                'outputs': cell.get('outputs', []),
+                'execution_count': cell.get('execution_count')
+            }).encode('utf8'))
+
+
+def execute_notebook(nb,
+                     cache=None,
+                     kernel_name='python3',
+                     timeout=600,
+                     cwd=None,
+                     extra=None):
+    """
+    Execute a notebook, reusing cached outputs wherever possible.
+
+    If every code cell is already in the cache the outputs are restored
+    without starting a kernel. Otherwise a kernel is started and every
+    code cell is run, in order: those before the first cache miss only
+    to rebuild kernel state (their cached outputs are kept), those from
+    the first miss onward to produce new outputs, which are cached. So
+    a change to a single cell still costs a run of everything up to it.
+
+    Parameters
+    ==========
+    nb: nbformat.notebooknode.NotebookNode
+        The notebook to execute. It is not modified.
+    cache: OutputCache
+        Where to look up and store outputs. Defaults to the user cache.
+    kernel_name: String
+        Jupyter kernel to run the notebook with.
+    timeout: int
+        Per-cell timeout in seconds.
+    cwd: String
+        Working directory for the kernel, so relative data paths resolve.
+    extra: String
+        Passed through to environment_hash.
+
+    Returns
+    =======
+    nb: nbformat.notebooknode.NotebookNode
+        A copy of the notebook with outputs filled in.
+    """
+    if cache is None:
+        cache = OutputCache()
+
+    nb = copy.deepcopy(nb)
+    keys = cell_keys(nb, environment_hash(nb, kernel_name, extra))
+
+    first_miss = None
+    for i in sorted(keys):
+        if keys[i] in cache:
+            cached = cache.get(keys[i])
+            nb.cells[i].outputs = cached['outputs']
+            nb.cells[i].execution_count = cached['execution_count']
+        elif first_miss is None:
+            first_miss = i
+
+    if first_miss is None:
+        print("All outputs cached for: " + str(nb.metadata.get('path')))
+        return nb
+
+    try:
+        from nbclient import NotebookClient
+    except ImportError:
+        raise ImportError(
+            "Executing notebooks requires nbclient: pip install nbclient")
+
+    import nbformat
+
+    client = NotebookClient(
+        nb,
+        kernel_name=kernel_name,
+        timeout=timeout,
+        resources={'metadata': {
+            'path': cwd or os.getcwd()
+        }})
+
+    print("Executing from cell " + str(first_miss) + " of " +
+          str(nb.metadata.get('path')))
+    with client.setup_kernel():
+        client.reset_execution_trackers()
+        for i in sorted(keys):
+            cell = nb.cells[i]
+            if i < first_miss:
+                # Replay for kernel state only; keep the cached outputs
+                replay = nbformat.from_dict(copy.deepcopy(cell))
+                client.execute_cell(replay, i)
+            else:
+                client.execute_cell(cell, i)
+                cache.put(keys[i], cell)
+
+    return nb
+
+
+def execute_notebooks(notebooks, max_kernels=None, cwds=None, **kwargs):
+    """
+    Execute several notebooks with at most max_kernels kernels running
+    at once.
+
+    Parameters
+    ==========
+    notebooks: dict
+        Mapping of name to nbformat.notebooknode.NotebookNode.
+    max_kernels: int
+        Maximum number of concurrent kernels. Defaults to the number
+        of CPUs.
+    cwds: dict
+        Optional mapping of name to the working directory to execute
+        that notebook in (see execute_notebook).
+    kwargs:
+        Passed on to execute_notebook.
+
+    Returns
+    =======
+    executed: dict
+        Mapping of name to executed notebook.
+    """
+    if max_kernels is None:
+        max_kernels = os.cpu_count() or 1
+
+    with ThreadPoolExecutor(max_workers=max_kernels) as pool:
+        futures = {
+            name: pool.submit(execute_notebook,
+                              nb,
+                              cwd=(cwds or {}).get(name),
+                              **kwargs)
+            for name, nb in notebooks.items()
+        }
+        return {name: f.result() for name, f in futures.items()}
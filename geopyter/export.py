@@ -0,0 +1,199 @@
+"""
+Render compiled notebooks to other formats (HTML, slides, Markdown
+and LaTeX) on a pool of worker processes, straight from memory.
+"""
+
+import hashlib
+import io
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+# Format name -> (nbconvert exporter name, output file suffix)
+FORMATS = {
+    'html': ('html', '.html'),
+    'slides': ('slides', '.slides.html'),
+    'markdown': ('markdown', '.md'),
+    'latex': ('latex', '.tex'),
+}
+
+MANIFEST = '.geopyter-export.json'
+
+# Exporters are expensive to build (template discovery, Jinja
+# environment) so each worker process keeps one per format.
+_exporters = {}
+
+
+def get_exporter(fmt):
+    """
+    Return the cached nbconvert exporter for a format, creating it
+    on first use in this process.
+
+    Parameters
+    ==========
+    fmt: String
+        One of the keys of FORMATS.
+
+    Returns
+    =======
+    An nbconvert.exporters.Exporter instance.
+    """
+    if fmt not in FORMATS:
+        raise ValueError("Unknown export format '{0}' (expected one of: {1})".
+                         format(fmt, ", ".join(sorted(FORMATS))))
+
+    if fmt not in _exporters:
+        try:
+            from nbconvert.exporters import get_exporter as nbc_exporter
+        except ImportError:
+            raise ImportError(
+                "Exporting notebooks requires nbconvert: pip install nbconvert")
+        _exporters[fmt] = nbc_exporter(FORMATS[fmt][0])()
+
+    return _exporters[fmt]
+
+
+def source_hash(nb, fmt):
+    """Hash a notebook and export format to detect unchanged outputs"""
+    h = hashlib.sha256()
+    h.update(fmt.encode('utf8'))
+    try:
+        import nbconvert
+        h.update(nbconvert.__version__.encode('utf8'))
+    except ImportError:
+        pass
+    h.update(json.dumps(nb, sort_keys=True).encode('utf8'))
+    return h.hexdigest()
+
+
+def _write_if_changed(fn, data):
+    """Write bytes to fn unless the file already holds exactly them"""
+    if os.path.exists(fn):
+        with io.open(fn, 'rb') as f:
+            if f.read() == data:
+                return False
+
+    os.makedirs(os.path.dirname(fn) or '.', exist_ok=True)
+    with io.open(fn, 'wb') as f:
+        f.write(data)
+    return True
+
+
+def render(nb, fmt, stem, out_dir):
+    """
+    Render one notebook in one format and write the result (plus any
+    extracted resources such as images) to out_dir.
+
+    Parameters
+    ==========
+    nb: nbformat.notebooknode.NotebookNode
+        The notebook to render.
+    fmt: String
+        One of the keys of FORMATS.
+    stem: String
+        Output file name without suffix.
+    out_dir: String
+        Directory in which to write the output.
+
+    Returns
+    =======
+    fn: String
+        Path of the main output file.
+    """
+    exporter = get_exporter(fmt)
+    resources = {
+        'unique_key': stem,
+        'output_files_dir': stem + '_files',
+    }
+    body, resources = exporter.from_notebook_node(nb, resources=resources)
+
+    fn = os.path.join(out_dir, stem + FORMATS[fmt][1])
+    if isinstance(body, str):
+        body = body.encode('utf8')
+    _write_if_changed(fn, body)
+
+    for name, data in resources.get('outputs', {}).items():
+        _write_if_changed(os.path.join(out_dir, name), data)
+
+    return fn
+
+
+def _render_job(nb, fmt, stem, out_dir):
+    # Top-level so it can be pickled for the process pool
+    import nbformat
+    return render(nbformat.from_dict(nb), fmt, stem, out_dir)
+
+
+def export_notebooks(notebooks,
+                     formats=('html', 'slides', 'markdown', 'latex'),
+                     out_dir='builds',
+                     max_workers=None,
+                     force=False):
+    """
+    Render several in-memory notebooks to several formats in parallel.
+
+    Every (notebook, format) pair is an independent job on a process
+    pool. A manifest in out_dir records the hash of each rendered input
+    so that pairs whose notebook has not changed since the last export
+    are skipped.
+
+    Parameters
+    ==========
+    notebooks: dict
+        Mapping of output stem (file name without suffix, optionally
+        with sub-directories) to nbformat.notebooknode.NotebookNode.
+    formats: iterable of String
+        Formats to produce; see FORMATS.
+    out_dir: String
+        Directory into which to render. Defaults to 'builds'.
+    max_workers: int
+        Size of the worker pool. Defaults to the number of CPUs.
+    force: boolean
+        Re-render everything, ignoring the manifest.
+
+    Returns
+    =======
+    written: dict
+        Mapping of (stem, format) to the output path, for the pairs that
+        were rendered on this call.
+    """
+    formats = list(formats)
+    for fmt in formats:
+        if fmt not in FORMATS:
+            raise ValueError("Unknown export format: " + fmt)
+
+    manifest_fn = os.path.join(out_dir, MANIFEST)
+    manifest = {}
+    if not force and os.path.exists(manifest_fn):
+        with io.open(manifest_fn, 'r', encoding='utf8') as f:
+            manifest = json.load(f)
+
+    jobs = []
+    for stem, nb in notebooks.items():
+        for fmt in formats:
+            key = stem + FORMATS[fmt][1]
+            digest = source_hash(nb, fmt)
+            fn = os.path.join(out_dir, key)
+            if manifest.get(key) == digest and os.path.exists(fn):
+                print("Unchanged, skipping: " + fn)
+                continue
+            jobs.append((stem, fmt, key, digest, nb))
+
+    written = {}
+    if jobs:
+        try:
+            with ProcessPoolExecutor(max_workers=max_workers) as pool:
+                futures = [(stem, fmt, key, digest,
+                            pool.submit(_render_job, nb, fmt, stem, out_dir))
+                           for stem, fmt, key, digest, nb in jobs]
+                for stem, fmt, key, digest, future in futures:
+                    written[(stem, fmt)] = future.result()
+                    manifest[key] = digest
+                    print("Exported: " + written[(stem, fmt)])
+        finally:
+            # Record whatever did render, even if another job failed
+            os.makedirs(out_dir, exist_ok=True)
+            with io.open(manifest_fn, 'w', encoding='utf8') as f:
+                json.dump(manifest, f, indent=1, sort_keys=True)
+
+    return written
@@ -0,0 +1,200 @@
+"""
+Shrink the images embedded in compiled notebooks: PNG and JPEG
+outputs (e.g. the maps in atoms/visualization) and markdown cell
+attachments are decoded, downsampled to a maximum width/height and
+re-encoded, on a pool of worker processes.
+
+Results are cached on disk by a hash of the image and the settings, so
+each distinct image is processed once however many sessions embed it
+and however often they are rebuilt. Images that do not get smaller are
+left exactly as they were. Requires Pillow: pip install Pillow.
+"""
+
+import base64
+import hashlib
+import io
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+from .core import DiskCache, copy_cell
+
+IMAGE_TYPES = {'image/png': 'PNG', 'image/jpeg': 'JPEG'}
+
+
+def recompress(data, mime, max_size=1024, quality=85):
+    """
+    Downsample and re-encode one image.
+
+    Parameters
+    ==========
+    data: bytes
+        The encoded image.
+    mime: String
+        'image/png' or 'image/jpeg'; the result has the same type.
+    max_size: int
+        Maximum width and height in pixels; larger images are scaled
+        down, keeping their aspect ratio.
+    quality: int
+        JPEG quality (1-95). PNGs are losslessly optimised.
+
+    Returns
+    =======
+    bytes, or None if the re-encoded image would not be smaller.
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        raise ImportError(
+            "Recompressing images requires Pillow: pip install Pillow")
+
+    img = Image.open(io.BytesIO(data))
+    if max_size and max(img.size) > max_size:
+        img.thumbnail((max_size, max_size), Image.LANCZOS)
+
+    out = io.BytesIO()
+    if IMAGE_TYPES[mime] == 'JPEG':
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        img.save(out, 'JPEG', quality=quality, optimize=True)
+    else:
+        img.save(out, 'PNG', optimize=True)
+
+    out = out.getvalue()
+    return out if len(out) < len(data) else None
+
+
+class ImageCache(DiskCache):
+    """Recompressed images stored on disk, one file per key"""
+
+    name = 'images'
+
+    def get(self, key):
+        """
+        Return the cached result for a key: bytes, None if the image
+        could not be made smaller, or KeyError if it was never cached.
+        """
+        return self.read(key) or None
+
+    def put(self, key, data):
+        self.write(key, data or b'')  # Empty means 'keep the original'
+
+
+def iter_images(cells):
+    """
+    Yield (cell index, container, mime) for every embedded image, where
+    container[mime] holds the base64 data: an output's 'data' or one
+    attachment of a markdown cell.
+    """
+    for i, cell in enumerate(cells):
+        for output in cell.get('outputs', ()):
+            data = output.get('data', {})
+            for mime in IMAGE_TYPES:
+                if mime in data:
+                    yield i, data, mime
+        for attachment in cell.get('attachments', {}).values():
+            for mime in IMAGE_TYPES:
+                if mime in attachment:
+                    yield i, attachment, mime
+
+
+def decode(b64):
+    if isinstance(b64, list):
+        b64 = ''.join(b64)
+    return base64.b64decode(b64)
+
+
+def optimize_images(nb,
+                    max_size=1024,
+                    quality=85,
+                    max_workers=None,
+                    cache_dir=None):
+    """
+    Recompress the embedded images of a notebook.
+
+    Parameters
+    ==========
+    nb: nbformat.notebooknode.NotebookNode
+        The notebook. It is not modified.
+    max_size: int
+        Maximum width and height in pixels.
+    quality: int
+        JPEG quality.
+    max_workers: int
+        Size of the process pool. Defaults to the number of CPUs.
+    cache_dir: String
+        Cache root. Defaults to ~/.cache/geopyter.
+
+    Returns
+    =======
+    nb: nbformat.notebooknode.NotebookNode
+        A copy of the notebook with smaller images (cells without
+        images are shared with the original).
+    """
+    settings = json.dumps([max_size, quality]).encode('utf8')
+    cache = ImageCache(cache_dir)
+
+    # Work out each image's key; identical images are handled once
+    found = []
+    todo = {}  # Key -> (bytes, mime)
+    results = {}  # Key -> bytes or None
+    for i, container, mime in iter_images(nb.cells):
+        data = decode(container[mime])
+        key = hashlib.sha256(settings + mime.encode('utf8') + b'\0' +
+                             data).hexdigest()
+        found.append((i, container, mime, key))
+        if key in results or key in todo:
+            continue
+        try:
+            results[key] = cache.get(key)
+        except KeyError:
+            todo[key] = (data, mime)
+
+    if todo:
+        print("Recompressing " + str(len(todo)) + " image(s) of " +
+              str(nb.metadata.get('path')))
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            futures = {
+                key: pool.submit(recompress, data, mime, max_size, quality)
+                for key, (data, mime) in todo.items()
+            }
+            for key, future in futures.items():
+                results[key] = future.result()
+                cache.put(key, results[key])
+
+    replace = {}  # Cell index -> {id(container): {mime: new base64}}
+    for i, container, mime, key in found:
+        if results[key] is not None:
+            replace.setdefault(i, {}).setdefault(id(container), {})[mime] = \
+                base64.b64encode(results[key]).decode('ascii')
+
+    if not replace:
+        return nb
+
+    def updated(container, changes):
+        """Copy a container with its changed images replaced, if any"""
+        if id(container) not in changes:
+            return container
+        new = type(container)(container)
+        new.update(changes[id(container)])
+        return new
+
+    cells = list(nb.cells)
+    for i, changes in replace.items():
+        old = cells[i]
+        new = copy_cell(old)
+        if 'outputs' in old:
+            new['outputs'] = []
+            for output in old['outputs']:
+                if id(output.get('data')) in changes:
+                    output = type(output)(output)
+                    output['data'] = updated(output['data'], changes)
+                new['outputs'].append(output)
+        if 'attachments' in old:
+            new['attachments'] = type(old['attachments'])(
+                (name, updated(a, changes))
+                for name, a in old['attachments'].items())
+        cells[i] = new
+
+    new_nb = type(nb)(nb)
+    new_nb['cells'] = cells
+    return new_nb
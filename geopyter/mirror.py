@@ -0,0 +1,235 @@
+"""
+Notebooks pinned to a git ref, served from local bare mirrors.
+
+An include can name a repository, a ref and a path:
+
+    @include {
+        src = git+https://github.com/pysal/geopyter.git@v0.1.0:atoms/foundations/Lists.ipynb
+    }
+
+The repository is mirrored once into the cache directory. Notebooks are
+read straight from the mirror's object store (nothing is checked out),
+the mirror is only fetched when the ref cannot be resolved locally, and
+each (commit, path) blob and each commit's metadata is cached on disk
+for good. Pinning to a tag or full commit SHA therefore makes builds
+reproducible and, after the first fetch, nearly free: a full SHA whose
+blob and metadata are cached is served without opening the mirror.
+Branch names resolve against the mirror as last fetched; pass
+refresh=True to pick up new commits.
+"""
+
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+
+from .core import atomic_write, get_cache_dir
+
+GIT_SRC = re.compile(r'^git\+(?P<repo>.+)@(?P<ref>[^@:\s]+):(?P<path>[^:]+)$')
+
+
+def is_git_src(nb_src):
+    return nb_src.strip().startswith('git+')
+
+
+def parse_git_src(nb_src):
+    """
+    Split a 'git+<repo>@<ref>:<path>' include source into its parts.
+
+    Returns
+    =======
+    tuple: (repo, ref, path)
+
+    Raises
+    ======
+    ValueError if the source is not in that form.
+    """
+    m = GIT_SRC.match(nb_src.strip())
+    if m is None:
+        raise ValueError("Expected 'git+<repo>@<ref>:<path>', got: " + nb_src)
+    return m.group('repo'), m.group('ref'), m.group('path').lstrip('/')
+
+
+def mirror_path(repo_url, cache_dir=None):
+    """Return the directory of the bare mirror for a repository"""
+    name = os.path.basename(repo_url.rstrip('/'))
+    name = re.sub(r'(?:\.git)?$', '', name, count=1)
+    digest = hashlib.sha1(repo_url.encode('utf8')).hexdigest()[:16]
+    return os.path.join(get_cache_dir('mirrors', cache_dir),
+                        digest + '-' + name + '.git')
+
+
+def get_mirror(repo_url, cache_dir=None):
+    """
+    Open the bare mirror of a repository, cloning it on first use.
+
+    Returns
+    =======
+    A git.Repo for the mirror.
+    """
+    from git import Repo
+
+    path = mirror_path(repo_url, cache_dir)
+    if not os.path.exists(path):
+        print("Mirroring " + repo_url + " into " + path)
+        # Clone beside the final location and rename, so a concurrent
+        # build never sees a half-cloned mirror
+        parent = os.path.dirname(path)
+        os.makedirs(parent, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=parent)
+        try:
+            Repo.clone_from(repo_url, os.path.join(tmp, 'repo'), mirror=True)
+            try:
+                os.rename(os.path.join(tmp, 'repo'), path)
+            except OSError:
+                if not os.path.exists(path):
+                    raise
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    return Repo(path)
+
+
+def resolve_ref(repo, ref, refresh=False):
+    """
+    Resolve a ref to a commit SHA in a mirror, fetching only if the
+    mirror doesn't know the ref yet (or refresh is True).
+
+    Raises
+    ======
+    ValueError if the ref cannot be resolved even after fetching.
+    """
+    from git import GitCommandError
+
+    def rev_parse():
+        try:
+            return repo.git.rev_parse('--verify', '--quiet',
+                                      ref + '^{commit}')
+        except GitCommandError:
+            return None
+
+    sha = None if refresh else rev_parse()
+    if sha is None:
+        print("Fetching " + ref + " into " + repo.git_dir)
+        repo.git.fetch('--prune', 'origin')
+        sha = rev_parse()
+    if sha is None:
+        raise ValueError("Unknown ref '" + ref + "' in " + repo.git_dir)
+    return sha
+
+
+def is_full_sha(ref):
+    return re.match('^[0-9a-f]{40}$', ref) is not None
+
+
+def blob_path(sha, path, cache_dir=None):
+    key = hashlib.sha1((sha + ':' + path).encode('utf8')).hexdigest()
+    return os.path.join(get_cache_dir('blobs', cache_dir), key[:2], key)
+
+
+def read_git_src(nb_src, cache_dir=None, refresh=False):
+    """
+    Return the content of a 'git+<repo>@<ref>:<path>' source.
+
+    Parameters
+    ==========
+    nb_src: String
+        The include source.
+    cache_dir: String
+        Cache root (see core.get_cache_dir).
+    refresh: boolean
+        Fetch before resolving the ref, e.g. to move a branch forward.
+
+    Returns
+    =======
+    tuple: (text, sha)
+        The decoded file content and the commit it was read from.
+    """
+    repo_url, ref, path = parse_git_src(nb_src)
+
+    # A full SHA needs neither the mirror nor a fetch once its blob is cached
+    if is_full_sha(ref) and not refresh:
+        fn = blob_path(ref, path, cache_dir)
+        if os.path.exists(fn):
+            with io.open(fn, 'rb') as f:
+                return f.read().decode('utf8'), ref
+
+    repo = get_mirror(repo_url, cache_dir)
+    sha = resolve_ref(repo, ref, refresh=refresh)
+
+    fn = blob_path(sha, path, cache_dir)
+    if os.path.exists(fn):
+        with io.open(fn, 'rb') as f:
+            return f.read().decode('utf8'), sha
+
+    try:
+        blob = repo.commit(sha).tree / path
+    except KeyError:
+        raise ValueError("No file '" + path + "' at " + ref + " (" + sha +
+                         ") in " + repo_url)
+    data = blob.data_stream.read()
+
+    with atomic_write(fn) as f:
+        f.write(data)
+
+    return data.decode('utf8'), sha
+
+
+def commit_path(sha, cache_dir=None):
+    return os.path.join(get_cache_dir('commits', cache_dir), sha[:2],
+                        sha + '.json')
+
+
+def commit_metadata(repo, sha, cache_dir=None):
+    """
+    Return the author and dates of a commit, caching them on disk by SHA
+    (they never change). repo may be a callable returning the mirror,
+    which is then only opened if the commit is not cached yet.
+    """
+    from datetime import datetime
+
+    fn = commit_path(sha, cache_dir)
+    if os.path.exists(fn):
+        with io.open(fn, 'r', encoding='utf8') as f:
+            return json.load(f)
+
+    if callable(repo):
+        repo = repo()
+    hc = repo.commit(sha)
+    meta = {
+        'author.name': hc.author.name,
+        'authored_date': datetime.fromtimestamp(
+            hc.authored_date).strftime('%Y-%m-%d %H:%M:%S'),
+        'committer.name': hc.committer.name,
+        'committed_date': datetime.fromtimestamp(
+            hc.committed_date).strftime('%Y-%m-%d %H:%M:%S'),
+        'sha': hc.hexsha,
+    }
+
+    with atomic_write(fn, 'w') as f:
+        json.dump(meta, f, sort_keys=True)
+    return meta
+
+
+def git_metadata(nb_src, cache_dir=None):
+    """
+    Return NoteBook-style git metadata for the commit a pinned source
+    resolves to. Commit details are cached by SHA, so a source pinned
+    to a full SHA that has been read before needs no git call.
+    """
+    repo_url, ref, path = parse_git_src(nb_src)
+
+    if is_full_sha(ref):
+        meta = commit_metadata(lambda: get_mirror(repo_url, cache_dir), ref,
+                               cache_dir)
+    else:
+        repo = get_mirror(repo_url, cache_dir)
+        meta = commit_metadata(repo, resolve_ref(repo, ref), cache_dir)
+
+    meta = dict(meta)
+    meta['active_branch'] = ref
+    meta['repository'] = repo_url
+    return meta
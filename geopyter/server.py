@@ -0,0 +1,220 @@
+"""
+A small HTTP server that compiles sessions on request:
+
+    GET /build/sessions/geodemographics.ipynb
+
+Parsed notebooks are kept in one registry across requests and only
+re-parsed when their file changes. Concurrent requests for the same
+session share a single compile, compiled notebooks are kept until one
+of their sources changes (and are then patched, re-expanding only the
+changed atoms, rather than recompiled), and responses carry an ETag derived from the
+source hashes of the whole include DAG so that clients and proxies can
+revalidate cheaply (If-None-Match gets a 304).
+"""
+
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from . import __version__
+from .core import NoteBook, resolve_nb_src
+
+PREFIX = '/build/'
+
+
+def walk(nb):
+    """Yield a NoteBook and every notebook it includes, each once"""
+    seen = set()
+    stack = [nb]
+    while stack:
+        n = stack.pop()
+        if n.key in seen:
+            continue
+        seen.add(n.key)
+        yield n
+        stack.extend(n.included_nbs.values())
+
+
+class SessionCompiler(object):
+    """
+    Compile sessions under a root directory, keeping parsed atoms and
+    compiled results warm between calls. Safe to use from many threads.
+
+    Parameters
+    ==========
+    root: String
+        Directory that request paths are relative to. Defaults to '.'.
+    """
+
+    def __init__(self, root='.'):
+        self.root = os.path.abspath(root)
+        self.registry = {}
+        self._stats = {}  # Local source path -> (mtime_ns, size) when parsed
+        self._compiled = {}  # Session key -> (etag, body, notebook)
+        self._inflight = {}  # Session key -> Future of (etag, body)
+        self._lock = threading.Lock()  # Guards _inflight
+        self._parse_lock = threading.Lock()  # Guards registry and _stats
+
+    def locate(self, path):
+        """Map a request path to a notebook under root, or None"""
+        fn = os.path.normpath(os.path.join(self.root, path.lstrip('/')))
+        if fn != self.root and not fn.startswith(self.root + os.sep):
+            return None
+        if not fn.endswith('.ipynb') or not os.path.isfile(fn):
+            return None
+        return fn
+
+    @staticmethod
+    def stat(key):
+        try:
+            st = os.stat(key)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def invalidate(self):
+        """
+        Drop every parsed notebook whose file has changed since it was
+        parsed, along with every notebook that (transitively) includes
+        it. URL and pinned git sources are never invalidated.
+        """
+        stale = set(key for key, st in self._stats.items()
+                    if self.stat(key) != st)
+        if not stale:
+            return
+
+        for key, nb in list(self.registry.items()):
+            if any(n.key in stale for n in walk(nb)):
+                print("Source changed, reloading: " + key)
+                del self.registry[key]
+                self._stats.pop(key, None)
+
+    def load(self, fn):
+        """Return the parsed, up-to-date NoteBook for a session file"""
+        key = resolve_nb_src(fn)
+        with self._parse_lock:
+            self.invalidate()
+            if key not in self.registry:
+                NoteBook(fn, registry=self.registry)
+                for k in self.registry:
+                    if k not in self._stats and os.path.isfile(k):
+                        self._stats[k] = self.stat(k)
+            return self.registry[key]
+
+    @staticmethod
+    def etag(nb):
+        """Hash the source hashes of every notebook in the include DAG"""
+        h = hashlib.sha256(__version__.encode('utf8'))
+        for source_hash in sorted(n.source_hash for n in walk(nb)):
+            h.update(source_hash.encode('utf8'))
+        return h.hexdigest()[:32]
+
+    def build(self, fn):
+        key = resolve_nb_src(fn)
+        nb = self.load(fn)
+        etag = self.etag(nb)
+
+        cached = self._compiled.get(key)
+        if cached is not None and cached[0] == etag:
+            return cached[:2]
+
+        compiled = nb.compile() if cached is None else nb.patch(cached[2])
+        body = json.dumps(compiled, sort_keys=True, indent=1,
+                          ensure_ascii=False).encode('utf8')
+        self._compiled[key] = (etag, body, compiled)
+        return etag, body
+
+    def get(self, fn):
+        """
+        Return (etag, body) for a session file. Concurrent calls for the
+        same session wait for a single build rather than each starting one.
+        """
+        key = resolve_nb_src(fn)
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+
+        if owner:
+            try:
+                future.set_result(self.build(fn))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    del self._inflight[key]
+
+        return future.result()
+
+
+class BuildRequestHandler(BaseHTTPRequestHandler):
+    """Serve GET /build/<path> from the server's SessionCompiler"""
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        if not path.startswith(PREFIX):
+            self.send_error(404, "Use " + PREFIX + "<path to notebook>")
+            return
+
+        compiler = self.server.compiler
+        fn = compiler.locate(path[len(PREFIX):])
+        if fn is None:
+            self.send_error(404, "No such notebook")
+            return
+
+        try:
+            etag, body = compiler.get(fn)
+        except Exception as e:
+            self.send_error(500, "Compile failed: " + str(e))
+            return
+
+        etag = '"' + etag + '"'
+        self.send_response(
+            304 if etag in self.headers.get('If-None-Match', '') else 200)
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        if etag in self.headers.get('If-None-Match', ''):
+            self.end_headers()
+            return
+
+        self.send_header('Content-Type', 'application/x-ipynb+json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class BuildServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, root='.'):
+        HTTPServer.__init__(self, address, BuildRequestHandler)
+        self.compiler = SessionCompiler(root)
+
+
+def serve(root='.', host='127.0.0.1', port=8000):
+    """
+    Serve compiled sessions from root until interrupted.
+
+    Parameters
+    ==========
+    root: String
+        Course directory; request paths are relative to it.
+    host: String
+        Address to bind. Defaults to localhost only.
+    port: int
+        Port to listen on. Defaults to 8000.
+    """
+    server = BuildServer((host, port), root=root)
+    print("Serving " + os.path.abspath(root) + " at http://" + host + ":" +
+          str(port) + PREFIX)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
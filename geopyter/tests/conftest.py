@@ -0,0 +1,59 @@
+import os
+import subprocess
+
+import pytest
+
+
+def git(cwd, *args):
+    return subprocess.check_output(('git', ) + args, cwd=cwd).decode().strip()
+
+
+def write_nb(path, title, contributors, cells=(), minor=5):
+    """
+    Write a small notebook: a metadata cell then markdown cells (or code
+    cells, given as nbformat cells). Before nbformat 4.5 (minor < 5), as
+    for most notebooks in the repository, cells have no ids.
+    """
+    import nbformat
+    from nbformat.v4 import new_markdown_cell, new_notebook
+
+    nb = new_notebook()
+    nb.cells = [
+        new_markdown_cell("# " + title + "\n\n- Contributors: " +
+                          contributors)
+    ] + [
+        new_markdown_cell(source) if isinstance(source, str) else source
+        for source in cells
+    ]
+    nb.nbformat_minor = minor
+    if minor < 5:
+        for cell in nb.cells:
+            del cell['id']
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    nbformat.write(nb, path)
+    return path
+
+
+def include(src):
+    return "@include {\n    src = " + src + "\n}"
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    """A private geopyter cache, and a git identity for test commits"""
+    monkeypatch.setenv('GEOPYTER_CACHE', str(tmp_path / 'cache'))
+    for var in ('GIT_AUTHOR_NAME', 'GIT_COMMITTER_NAME'):
+        monkeypatch.setenv(var, 'Tester')
+    for var in ('GIT_AUTHOR_EMAIL', 'GIT_COMMITTER_EMAIL'):
+        monkeypatch.setenv(var, 'tester@example.com')
+    return str(tmp_path / 'cache')
+
+
+@pytest.fixture
+def course(tmp_path, cache):
+    """An empty course directory that is a git repository"""
+    path = tmp_path / 'course'
+    path.mkdir()
+    git(str(path), 'init', '-q')
+    git(str(path), 'commit', '-q', '--allow-empty', '-m', 'Start')
+    return str(path)
@@ -0,0 +1,38 @@
+import asyncio
+import os
+
+import geopyter.core
+from geopyter.aio import aload
+
+from .conftest import include, write_nb
+
+
+def test_aload_reuses_registered_notebooks(course, monkeypatch):
+    monkeypatch.chdir(course)
+    write_nb(os.path.join(course, 'atoms', 'b.ipynb'), 'B', 'Bob',
+             ['b text'])
+    write_nb(os.path.join(course, 'session.ipynb'), 'Session', 'Sam',
+             [include('atoms/b.ipynb')])
+
+    reads = []
+    read_nb = geopyter.core.read_nb
+
+    def counting_read_nb(nb_src, *args, **kwargs):
+        reads.append(os.path.basename(nb_src))
+        return read_nb(nb_src, *args, **kwargs)
+
+    monkeypatch.setattr(geopyter.core, 'read_nb', counting_read_nb)
+    monkeypatch.setattr('geopyter.aio.read_nb', counting_read_nb)
+
+    async def load():
+        registry = {}
+        session = await aload('session.ipynb', registry=registry)
+        b = await aload('atoms/b.ipynb', registry=registry)
+        again = await aload('session.ipynb', registry=registry)
+        return registry, session, b, again
+
+    registry, session, b, again = asyncio.run(load())
+
+    assert sorted(reads) == ['b.ipynb', 'session.ipynb']
+    assert b is registry[os.path.join(course, 'atoms', 'b.ipynb')]
+    assert again is session
@@ -0,0 +1,49 @@
+import io
+import os
+import shutil
+
+from geopyter.assets import bundle_assets
+from geopyter.core import NoteBook
+from geopyter.validate import writes_nb
+
+from .conftest import include, write_nb
+
+
+def make_course(course):
+    write_nb(os.path.join(course, 'atoms', 'maps.ipynb'), 'Maps', 'Ann',
+             ['![A map](img/map.png)'])
+    os.makedirs(os.path.join(course, 'atoms', 'img'))
+    with io.open(os.path.join(course, 'atoms', 'img', 'map.png'), 'wb') as f:
+        f.write(b'not really a png')
+    return write_nb(os.path.join(course, 'session.ipynb'), 'Session', 'Sam',
+                    [include('atoms/maps.ipynb')])
+
+
+def test_compiled_independent_of_checkout(tmp_path, course, monkeypatch):
+    make_course(course)
+    moved = str(tmp_path / 'elsewhere' / 'course')
+    shutil.copytree(course, moved, symlinks=True)
+
+    compiled = []
+    for path in (course, moved):
+        monkeypatch.chdir(path)
+        nb = NoteBook('session.ipynb')
+        compiled.append((nb.content_hash, writes_nb(nb.compile())))
+        assert path not in compiled[-1][1]
+
+    assert compiled[0] == compiled[1]
+
+
+def test_assets_resolve_from_source_atom(tmp_path, course, monkeypatch):
+    make_course(course)
+    monkeypatch.chdir(course)
+    nb = NoteBook('session.ipynb').compile()
+
+    out_fn = str(tmp_path / 'build' / 'session.ipynb')
+    new = bundle_assets(nb, out_fn, str(tmp_path / 'build' / 'assets'))
+
+    source = ''.join(c.source for c in new.cells)
+    assert 'img/map.png' not in source
+    ref = source.split('](', 1)[1].split(')', 1)[0]
+    assert ref.startswith('assets/')
+    assert os.path.isfile(os.path.join(str(tmp_path / 'build'), ref))
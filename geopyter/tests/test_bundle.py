@@ -0,0 +1,118 @@
+import io
+import json
+import os
+import struct
+import zipfile
+
+from geopyter.bundle import bundle_course, write_zip
+
+from .test_assets import make_course
+
+
+def sample_members(tmp_path):
+    big = str(tmp_path / 'big.csv')
+    with io.open(big, 'wb') as f:
+        f.write(b'x,y\n' + b'1,2\n' * 300000)  # Larger than a read block
+    return [
+        ('notes.txt', b'geopyter ' * 1000),
+        ('noise.bin', os.urandom(4096)),  # Incompressible, so stored
+        ('empty.txt', b''),
+        ('data/big.csv', big),
+        (u'données/é.txt', u'accents é'.encode('utf8')),
+    ]
+
+
+def contents(members):
+    result = {}
+    for name, source in members:
+        if not isinstance(source, bytes):
+            with io.open(source, 'rb') as f:
+                source = f.read()
+        result[name] = source
+    return result
+
+
+def raw_members(fn):
+    """The compressed bytes of each member, as stored in the archive"""
+    with zipfile.ZipFile(fn) as z, io.open(fn, 'rb') as f:
+        raw = {}
+        for info in z.infolist():
+            f.seek(info.header_offset)
+            header = struct.unpack('<4s5H3L2H', f.read(30))
+            f.seek(header[-2] + header[-1], io.SEEK_CUR)
+            raw[info.filename] = (info.compress_type,
+                                  f.read(info.compress_size))
+        return raw
+
+
+def test_zip_round_trip(tmp_path):
+    members = sample_members(tmp_path)
+    fn = str(tmp_path / 'out' / 'course.zip')
+
+    stats = write_zip(members, fn, max_workers=2)
+
+    assert stats == {'compressed': len(members), 'reused': 0}
+    with zipfile.ZipFile(fn) as z:
+        assert z.testzip() is None
+        assert z.namelist() == [name for name, _ in members]
+        assert dict((n, z.read(n)) for n in z.namelist()) == \
+            contents(members)
+        types = dict((i.filename, i.compress_type) for i in z.infolist())
+    assert types['notes.txt'] == zipfile.ZIP_DEFLATED
+    assert types['noise.bin'] == zipfile.ZIP_STORED
+
+
+def test_zip_reuses_unchanged_members(tmp_path):
+    members = sample_members(tmp_path)
+    fn = str(tmp_path / 'course.zip')
+    write_zip(members, fn, level=1)
+    with io.open(fn, 'rb') as f:
+        first = f.read()
+
+    # A different level would give different bytes if anything was
+    # compressed again
+    stats = write_zip(members, fn, level=9)
+
+    assert stats == {'compressed': 0, 'reused': len(members)}
+    with io.open(fn, 'rb') as f:
+        assert f.read() == first
+
+
+def test_zip_recompresses_changed_members(tmp_path):
+    members = sample_members(tmp_path)
+    fn = str(tmp_path / 'course.zip')
+    write_zip(members, fn, level=1)
+    before = raw_members(fn)
+
+    members[0] = ('notes.txt', b'changed ' * 1000)
+    stats = write_zip(members, fn, level=9)
+
+    assert stats == {'compressed': 1, 'reused': len(members) - 1}
+    after = raw_members(fn)
+    assert after['notes.txt'] != before['notes.txt']
+    for name, _ in members[1:]:
+        assert after[name] == before[name]
+    with zipfile.ZipFile(fn) as z:
+        assert z.testzip() is None
+        assert z.read('notes.txt') == b'changed ' * 1000
+
+
+def test_bundle_course(tmp_path, course, monkeypatch):
+    make_course(course)
+    monkeypatch.chdir(course)
+    fn = str(tmp_path / 'course.zip')
+
+    assert bundle_course(['session.ipynb'], fn) == \
+        {'compressed': 2, 'reused': 0}
+    with zipfile.ZipFile(fn) as z:
+        assert z.testzip() is None
+        names = z.namelist()
+        nb = json.loads(z.read('session.ipynb').decode('utf8'))
+    asset = [n for n in names if n.startswith('assets/')]
+    assert names == ['session.ipynb'] + asset
+    assert asset[0].endswith('/map.png')
+    assert '](' + asset[0] + ')' in ''.join(
+        ''.join(c['source']) for c in nb['cells'])
+
+    assert bundle_course(['session.ipynb'], fn) == \
+        {'compressed': 0, 'reused': 2}
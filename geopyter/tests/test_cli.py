@@ -0,0 +1,51 @@
+import io
+import json
+import os
+
+from geopyter.cli import main
+
+from .test_assets import make_course
+
+
+def test_build_variants_with_assets(tmp_path, course, monkeypatch):
+    make_course(course)
+    monkeypatch.chdir(course)
+    out_dir = str(tmp_path / 'builds')
+
+    assert main([
+        'build', 'session.ipynb', '--variant', 'student', '--variant',
+        'instructor', '--assets', '--strict', '-o', out_dir
+    ]) == 0
+
+    for name in ('student', 'instructor'):
+        fn = os.path.join(out_dir, 'session-' + name + '.ipynb')
+        with io.open(fn, 'r', encoding='utf8') as f:
+            text = f.read()
+        assert 'img/map.png' not in text
+        assert '](assets/' in text
+    assert os.path.isdir(os.path.join(out_dir, 'assets'))
+
+
+def test_build_executes_with_atom_data(tmp_path, course, monkeypatch):
+    from nbformat.v4 import new_code_cell
+
+    from .conftest import include, write_nb
+
+    monkeypatch.chdir(course)
+    atom_dir = os.path.join(course, 'atoms', 'foundations')
+    write_nb(os.path.join(atom_dir, 'reading.ipynb'), 'Reading', 'Ann',
+             [new_code_cell("print(open('data/x.csv').read())")])
+    os.makedirs(os.path.join(atom_dir, 'data'))
+    with io.open(os.path.join(atom_dir, 'data', 'x.csv'), 'w') as f:
+        f.write(u'a,b\n1,2\n')
+    write_nb(os.path.join(course, 'session.ipynb'), 'Session', 'Sam',
+             [include('atoms/foundations/reading.ipynb')])
+    out_dir = str(tmp_path / 'builds')
+
+    assert main(['build', 'session.ipynb', '--execute', '-o', out_dir]) == 0
+
+    with io.open(os.path.join(out_dir, 'session.ipynb'), 'r',
+                 encoding='utf8') as f:
+        cells = json.load(f)['cells']
+    outputs = [o for c in cells for o in c.get('outputs', [])]
+    assert [''.join(o['text']) for o in outputs] == ['a,b\n1,2\n\n']
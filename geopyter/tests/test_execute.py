@@ -0,0 +1,24 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from nbformat.v4 import new_code_cell, new_output
+
+from geopyter.execute import OutputCache
+
+
+def test_output_cache_concurrent_puts(cache):
+    outputs = OutputCache()
+    cell = new_code_cell('print(1)',
+                         outputs=[new_output('stream', text='1\n')],
+                         execution_count=1)
+
+    # Sessions and variants that start alike share keys, and are
+    # executed on threads of one process
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        list(pool.map(lambda i: outputs.put('ab' + str(i % 2), cell),
+                      range(400)))
+
+    for key in ('ab0', 'ab1'):
+        assert outputs.get(key).outputs[0].text == '1\n'
+    assert sorted(os.listdir(os.path.dirname(outputs.path('ab0')))) == \
+        ['ab0.json', 'ab1.json']
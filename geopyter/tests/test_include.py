@@ -0,0 +1,85 @@
+import os
+from collections import Counter
+
+import pytest
+from nbformat.v4 import new_code_cell
+
+import geopyter.core
+from geopyter.core import IncludeCycleError, NoteBook
+
+from .conftest import include, write_nb
+
+
+def test_include_cycle(course, monkeypatch):
+    monkeypatch.chdir(course)
+    write_nb(os.path.join(course, 'atoms', 'x.ipynb'), 'X', 'Xia',
+             [include('atoms/y.ipynb')])
+    write_nb(os.path.join(course, 'atoms', 'y.ipynb'), 'Y', 'Yan',
+             [include('atoms/x.ipynb')])
+
+    with pytest.raises(IncludeCycleError) as e:
+        NoteBook('atoms/x.ipynb')
+
+    x = os.path.join(course, 'atoms', 'x.ipynb')
+    y = os.path.join(course, 'atoms', 'y.ipynb')
+    assert e.value.cycle == (x, y, x)
+    assert str(e.value) == "Cyclic @include detected: " + " -> ".join(
+        (x, y, x))
+
+
+def test_diamond_reads_and_expands_shared_atom_once(course, monkeypatch):
+    monkeypatch.chdir(course)
+    write_nb(os.path.join(course, 'atoms', 'c.ipynb'), 'C', 'Cat',
+             ['## Csec', 'shared text'])
+    for name in ('a', 'b'):
+        write_nb(os.path.join(course, 'atoms', name + '.ipynb'),
+                 name.upper(), 'Ann', [include('atoms/c.ipynb')])
+    write_nb(os.path.join(course, 'session.ipynb'), 'Session', 'Sam',
+             [include('atoms/a.ipynb'), include('atoms/b.ipynb')])
+
+    reads = Counter()
+    read_nb = geopyter.core.read_nb
+
+    def counting_read_nb(nb_src, *args, **kwargs):
+        reads[os.path.basename(nb_src)] += 1
+        return read_nb(nb_src, *args, **kwargs)
+
+    expansions = Counter()
+    expand = NoteBook.expand
+
+    def counting_expand(self, *args, **kwargs):
+        expansions[os.path.basename(self.nb_path)] += 1
+        return expand(self, *args, **kwargs)
+
+    monkeypatch.setattr(geopyter.core, 'read_nb', counting_read_nb)
+    monkeypatch.setattr(NoteBook, 'expand', counting_expand)
+
+    compiled = NoteBook('session.ipynb').compile()
+
+    assert reads == Counter({
+        'session.ipynb': 1,
+        'a.ipynb': 1,
+        'b.ipynb': 1,
+        'c.ipynb': 1
+    })
+    assert expansions['c.ipynb'] == 1
+    assert [c.source for c in compiled.cells].count('shared text') == 2
+
+
+def test_include_last_section(course, monkeypatch):
+    monkeypatch.chdir(course)
+    write_nb(os.path.join(course, 'atoms', 'c.ipynb'), 'C', 'Cat', [
+        '## First', 'first text', '## Last', 'last text',
+        new_code_cell('x = 1')
+    ])
+    write_nb(os.path.join(course, 'session.ipynb'), 'Session', 'Sam', [
+        "@include {\n    src = atoms/c.ipynb\n    select = h2.Last\n}",
+        'after'
+    ])
+
+    sources = [c.source for c in NoteBook('session.ipynb').compile().cells]
+
+    assert 'first text' not in sources
+    start = sources.index('## Last')
+    assert sources[start:start + 4] == ['## Last', 'last text', 'x = 1',
+                                        'after']
@@ -0,0 +1,74 @@
+import os
+import shutil
+
+from geopyter.core import NoteBook
+from geopyter.mirror import blob_path, mirror_path
+
+from .conftest import git, include, write_nb
+
+
+def make_upstream(tmp_path):
+    """A local repository with an atom tagged at v1 and v2"""
+    repo = str(tmp_path / 'upstream')
+    os.makedirs(repo)
+    git(repo, 'init', '-q')
+    atom = os.path.join(repo, 'atoms', 'leaf.ipynb')
+    write_nb(atom, 'Leaf', 'Ann', ['version one'])
+    git(repo, 'add', '.')
+    git(repo, 'commit', '-q', '-m', 'v1')
+    git(repo, 'tag', 'v1')
+    write_nb(atom, 'Leaf', 'Ann', ['version two'])
+    git(repo, 'commit', '-q', '-am', 'v2')
+    git(repo, 'tag', 'v2')
+    return repo
+
+
+def compiled_text(course, src):
+    fn = write_nb(os.path.join(course, 'session.ipynb'), 'Session', 'Sam',
+                  [include(src)])
+    nb = NoteBook(fn)
+    return ''.join(c.source for c in nb.compile().cells)
+
+
+def test_pinned_tags(tmp_path, course, capsys):
+    upstream = make_upstream(tmp_path)
+
+    assert 'version one' in compiled_text(
+        course, 'git+' + upstream + '@v1:atoms/leaf.ipynb')
+    assert 'version two' in compiled_text(
+        course, 'git+' + upstream + '@v2:atoms/leaf.ipynb')
+    out = capsys.readouterr().out
+    assert out.count('Mirroring ') == 1
+    assert 'Fetching ' not in out  # Both tags were in the first clone
+
+
+def test_fetch_only_once(tmp_path, course, capsys):
+    upstream = make_upstream(tmp_path)
+    compiled_text(course, 'git+' + upstream + '@v1:atoms/leaf.ipynb')
+
+    # A tag created after the mirror was made is fetched once, then known
+    write_nb(os.path.join(upstream, 'atoms', 'leaf.ipynb'), 'Leaf', 'Ann',
+             ['version three'])
+    git(upstream, 'commit', '-q', '-am', 'v3')
+    git(upstream, 'tag', 'v3')
+    capsys.readouterr()
+
+    for i in range(2):
+        assert 'version three' in compiled_text(
+            course, 'git+' + upstream + '@v3:atoms/leaf.ipynb')
+    assert capsys.readouterr().out.count('Fetching ') == 1
+
+
+def test_cached_sha_without_mirror(tmp_path, course, cache):
+    upstream = make_upstream(tmp_path)
+    sha = git(upstream, 'rev-parse', 'v1')
+    src = 'git+' + upstream + '@' + sha + ':atoms/leaf.ipynb'
+
+    assert 'version one' in compiled_text(course, src)
+    assert os.path.exists(blob_path(sha, 'atoms/leaf.ipynb'))
+
+    # Neither the mirror nor the upstream repository is needed any more
+    shutil.rmtree(mirror_path(upstream))
+    shutil.rmtree(upstream)
+    assert 'version one' in compiled_text(course, src)
+    assert not os.path.exists(mirror_path(upstream))
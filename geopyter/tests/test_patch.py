@@ -0,0 +1,102 @@
+import io
+import json
+import os
+
+from nbformat.v4 import new_code_cell, new_markdown_cell
+
+from geopyter.cli import main
+from geopyter.core import NoteBook, VARIANTS
+
+from .conftest import git, include, write_nb
+
+
+def make_course(course, c_text='c text'):
+    write_nb(os.path.join(course, 'atoms', 'c.ipynb'), 'C', 'Cat',
+             ['## Csec', c_text,
+              new_code_cell('x = 1', metadata={'tags': ['solution']})])
+    write_nb(os.path.join(course, 'atoms', 'a.ipynb'), 'A', 'Ann', [
+        'a text',
+        include('atoms/c.ipynb'),
+        new_markdown_cell('a note', metadata={'tags': ['instructor']}),
+        new_markdown_cell('a aside',
+                          metadata={'slideshow': {'slide_type': 'skip'}}),
+    ])
+    write_nb(os.path.join(course, 'atoms', 'b.ipynb'), 'B', 'Bob',
+             ['b text', new_code_cell('y = 2')])
+    write_nb(os.path.join(course, 'session.ipynb'), 'Session', 'Sam', [
+        include('atoms/a.ipynb'), 'between',
+        include('atoms/b.ipynb')
+    ])
+    git(course, 'add', '.')
+    git(course, 'commit', '-q', '-m', 'Course')
+
+
+def dumps(nb):
+    return json.dumps(nb, sort_keys=True)
+
+
+def test_patch_equals_full_compile(course, monkeypatch, capsys):
+    monkeypatch.chdir(course)
+    make_course(course)
+    previous = NoteBook('session.ipynb').compile_variants()
+
+    # Edit one atom and commit, which moves HEAD for every notebook
+    write_nb(os.path.join(course, 'atoms', 'c.ipynb'), 'C', 'Cat',
+             ['## Csec', 'c text, edited',
+              new_code_cell('x = 1', metadata={'tags': ['solution']})])
+    git(course, 'commit', '-q', '-am', 'Edit c')
+    capsys.readouterr()
+
+    nb = NoteBook('session.ipynb')
+    patched = dict((v.name, nb.patch(previous[v.name])) for v in VARIANTS)
+    out = capsys.readouterr().out
+    full = NoteBook('session.ipynb').compile_variants()
+
+    assert 'Recompiling' not in out
+    assert out.count('Patched') == len(VARIANTS)
+    assert 'expanded 0' not in out
+    for v in VARIANTS:
+        assert 'c text, edited' in dumps(patched[v.name])
+        assert dumps(patched[v.name]) == dumps(full[v.name])
+    assert patched['student'] != patched['instructor']
+
+
+def test_patch_after_session_edit_recompiles(course, monkeypatch, capsys):
+    monkeypatch.chdir(course)
+    make_course(course)
+    previous = NoteBook('session.ipynb').compile()
+
+    write_nb(os.path.join(course, 'session.ipynb'), 'Session', 'Sam',
+             [include('atoms/b.ipynb')])
+    capsys.readouterr()
+    nb = NoteBook('session.ipynb')
+    patched = nb.patch(previous)
+
+    assert 'Recompiling' in capsys.readouterr().out
+    assert dumps(patched) == dumps(NoteBook('session.ipynb').compile())
+
+
+def test_build_patches_previous_build(tmp_path, course, monkeypatch,
+                                      capsys):
+    monkeypatch.chdir(course)
+    make_course(course)
+    out_dir = str(tmp_path / 'builds')
+    full_dir = str(tmp_path / 'full')
+    args = ['build', 'session.ipynb', '--variant', 'student']
+
+    assert main(args + ['-o', out_dir]) == 0
+    write_nb(os.path.join(course, 'atoms', 'b.ipynb'), 'B', 'Bob',
+             ['b text, edited', new_code_cell('y = 2')])
+    capsys.readouterr()
+    assert main(args + ['-o', out_dir]) == 0
+    assert 'Patched' in capsys.readouterr().out
+    assert main(args + ['--full', '-o', full_dir]) == 0
+    assert 'Patched' not in capsys.readouterr().out
+
+    texts = []
+    for d in (out_dir, full_dir):
+        with io.open(os.path.join(d, 'session-student.ipynb'), 'r',
+                     encoding='utf8') as f:
+            texts.append(f.read())
+    assert 'b text, edited' in texts[0]
+    assert texts[0] == texts[1]
@@ -0,0 +1,78 @@
+import io
+import os
+
+from geopyter.core import NoteBook, VARIANTS
+
+from .conftest import write_nb
+
+
+def test_shards_leave_source_alone(course):
+    fn = write_nb(os.path.join(course, 'session.ipynb'), 'Session', 'Sam',
+                  ['# One', '# Two'])
+    with io.open(fn, 'rb') as f:
+        before = f.read()
+
+    paths = NoteBook(fn).write_shards()
+
+    with io.open(fn, 'rb') as f:
+        assert f.read() == before
+    assert paths[0] == os.path.join(course, 'session-compiled.ipynb')
+    assert all(
+        os.path.dirname(p) == os.path.join(course, 'session-compiled')
+        for p in paths[1:])
+
+
+
+def shard_refs(fn):
+    import json
+    import re
+
+    with io.open(fn, 'r', encoding='utf8') as f:
+        source = ''.join(''.join(c['source']) for c in json.load(f)['cells'])
+    return re.findall(r'\]\(([^)]+)\)', source)
+
+
+def test_shards_of_a_variant_with_assets(tmp_path, course, monkeypatch):
+    from .test_assets import make_course
+
+    monkeypatch.chdir(course)
+    make_course(course)
+    nb = NoteBook('session.ipynb')
+    student = nb.compile_variants([v for v in VARIANTS
+                                   if v.name == 'student'])['student']
+    out_dir = str(tmp_path / 'builds')
+
+    paths = nb.write_shards(out_dir=out_dir,
+                            nb=student,
+                            stem='session-student',
+                            assets_dir=os.path.join(out_dir, 'assets'))
+
+    assert paths[0] == os.path.join(out_dir, 'session-student.ipynb')
+    refs = [(fn, ref) for fn in paths[1:] for ref in shard_refs(fn)]
+    assert refs
+    for fn, ref in refs:
+        assert ref.startswith('../assets/')
+        assert os.path.isfile(os.path.join(os.path.dirname(fn), ref))
+
+
+def test_build_shard_level(tmp_path, course, monkeypatch):
+    from geopyter.cli import main
+
+    from .test_assets import make_course
+
+    monkeypatch.chdir(course)
+    make_course(course)
+    out_dir = str(tmp_path / 'builds')
+
+    assert main([
+        'build', 'session.ipynb', '--assets', '--shard-level', '1', '-o',
+        out_dir
+    ]) == 0
+
+    shard_dir = os.path.join(out_dir, 'session')
+    shards = sorted(os.listdir(shard_dir))
+    assert len(shards) > 1
+    assert ['../assets/' in ref for fn in shards
+            for ref in shard_refs(os.path.join(shard_dir, fn))] == [True]
+    assert 'session/' + shards[0] in ''.join(
+        shard_refs(os.path.join(out_dir, 'session.ipynb')))
@@ -0,0 +1,49 @@
+import io
+import json
+import os
+
+import nbformat
+import pytest
+
+from geopyter.core import NoteBook
+from geopyter.validate import writes_nb
+
+from .conftest import include, write_nb
+
+
+@pytest.mark.parametrize('minor', [2, 5])
+def test_compiled_notebooks_are_valid(tmp_path, course, monkeypatch, capsys,
+                                      minor):
+    monkeypatch.chdir(course)
+    write_nb(os.path.join(course, 'atoms', 'leaf.ipynb'),
+             'Leaf',
+             'Ann', ['## Part', 'text'],
+             minor=minor)
+    fn = write_nb(os.path.join(course, 'session.ipynb'),
+                  'Session',
+                  'Sam', [include('atoms/leaf.ipynb'),
+                          include('atoms/leaf.ipynb')],
+                  minor=minor)
+
+    nb = NoteBook(fn)
+    for name, compiled in nb.compile_variants().items():
+        out_fn = str(tmp_path / (name + '.ipynb'))
+        nb.write(out_fn, nb=compiled, strict=True)
+        with io.open(out_fn, 'r', encoding='utf8') as f:
+            written = json.load(f)
+        assert written['nbformat_minor'] == minor
+        nbformat.validate(written)
+
+    assert 'invalid' not in capsys.readouterr().out
+
+
+def test_invalid_notebooks_reported_when_written(course, capsys):
+    nb = nbformat.v4.new_notebook()
+    nb.nbformat_minor = 2
+    nb.cells = [nbformat.v4.new_markdown_cell('Has an id')]
+
+    writes_nb(nb, nb_src='bad.ipynb')
+    assert 'Notebook JSON is invalid (bad.ipynb)' in capsys.readouterr().out
+
+    with pytest.raises(nbformat.ValidationError):
+        writes_nb(nb, strict=True)
@@ -0,0 +1,164 @@
+"""
+Notebook schema validation as an explicit, cached stage.
+
+nbformat validates every notebook it reads or writes against the JSON
+schema, which is slow, and for a build is mostly repeated work: the
+same atoms are validated on every build, and the compiled notebook,
+assembled from their already-validated cells, is validated again as a
+whole when it is written. Here each notebook, source or compiled, is
+validated once per content (and nbformat version) and the result kept
+on disk, so rebuilding unchanged sessions validates nothing. Invalid
+notebooks are reported, as nbformat does, or rejected when strict
+validation is asked for.
+"""
+
+import hashlib
+import io
+
+from .core import DiskCache
+
+
+class ValidationCache(DiskCache):
+    """
+    Validation results stored on disk, one small file per notebook
+    content: empty for a valid notebook, otherwise the error message.
+    """
+
+    name = 'validation'
+
+    @staticmethod
+    def key(text):
+        import nbformat
+
+        h = hashlib.sha256(nbformat.__version__.encode('utf8'))
+        h.update(b'\0')
+        h.update(text.encode('utf8') if isinstance(text, str) else text)
+        return h.hexdigest()
+
+    def get(self, key):
+        """
+        Return the cached error message for a key ('' if the notebook is
+        valid), or None if it has not been validated yet.
+        """
+        try:
+            return self.read(key).decode('utf8')
+        except KeyError:
+            return None
+
+    def put(self, key, error):
+        self.write(key, error.encode('utf8'))
+
+
+def validation_error(nb):
+    """
+    Validate a notebook, or notebook JSON; return the error message, or
+    '' if it is valid.
+    """
+    import nbformat
+    from nbformat.reader import reads
+
+    try:
+        if isinstance(nb, str):
+            nb = reads(nb)
+        nbformat.validate(nb)
+    except (nbformat.ValidationError, nbformat.NBFormatError,
+            ValueError) as e:
+        return str(e).split('\n', 1)[0]
+    return ''
+
+
+def cached_validation_error(text, nb=None, cache=None):
+    """
+    Return the validation error message for notebook JSON ('' if it is
+    valid), validating only if the same content has not been before.
+    nb is the parsed text, if the caller already has it.
+    """
+    if cache is None:
+        cache = ValidationCache()
+    key = cache.key(text)
+    error = cache.get(key)
+    if error is None:
+        error = validation_error(text if nb is None else nb)
+        cache.put(key, error)
+    return error
+
+
+def reads_nb(text, nb_src=None, cache=None):
+    """
+    Parse a notebook without nbformat's implicit validation, validating
+    it here instead unless a notebook with the same content already has
+    been. Like nbformat, invalid notebooks are reported, not rejected.
+
+    Parameters
+    ==========
+    text: String
+        The notebook JSON.
+    nb_src: String
+        Where it came from, for messages.
+    cache: ValidationCache
+        Where to look up and store the result. Defaults to the user cache.
+
+    Returns
+    =======
+    An object of class nbformat.notebooknode.NotebookNode (not converted).
+    """
+    from nbformat.reader import reads
+
+    nb = reads(text)
+    error = cached_validation_error(text, nb, cache)
+    if error:
+        print("Notebook JSON is invalid (" + str(nb_src) + "): " + error)
+    return nb
+
+
+def writes_nb(nb, strict=False, nb_src=None, cache=None):
+    """
+    Serialise a notebook as nbformat.writes does. Like nbformat, an
+    invalid notebook is reported but still serialised, unless strict is
+    True; the validation itself is skipped if a notebook with the same
+    content has been validated before.
+
+    Parameters
+    ==========
+    nb: nbformat.notebooknode.NotebookNode
+        The notebook.
+    strict: boolean
+        Raise rather than report if the notebook is invalid.
+    nb_src: String
+        Where it is going, for messages.
+    cache: ValidationCache
+        Where to look up and store the result. Defaults to the user cache.
+
+    Raises
+    ======
+    nbformat.ValidationError if strict is True and the notebook is invalid.
+    """
+    import nbformat
+    from nbformat.reader import get_version
+
+    major, _ = get_version(nb)
+    text = nbformat.versions[major].writes_json(nb)
+    error = cached_validation_error(text, nb, cache)
+    if error:
+        if strict:
+            nbformat.validate(nb)  # Raises with the full details
+        print("Notebook JSON is invalid (" + str(nb_src) + "): " + error)
+    return text
+
+
+def validate_notebooks(paths, cache=None):
+    """
+    Validate notebook files, using and filling the cache.
+
+    Returns
+    =======
+    errors: dict
+        Mapping of path to error message, for the invalid notebooks.
+    """
+    errors = {}
+    for path in paths:
+        with io.open(path, 'r', encoding='utf8') as f:
+            error = cached_validation_error(f.read(), cache=cache)
+        if error:
+            errors[path] = error
+    return errors
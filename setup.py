@@ -75,6 +75,9 @@ def setup_package():
         ],
         install_requires=install_reqs,
         extras_require=extras_reqs,
+        entry_points={
+            'console_scripts': ['geopyter=geopyter.cli:main'],
+        },
         cmdclass={'build_py': build_py},
         python_requires='>3.5'
     )